@@ -0,0 +1,352 @@
+"""
+Inference backends for the DSen2 models. The HDF5 weights are converted once to a
+SavedModel, a TFLite or an ONNX model next to the weights, e.g.
+
+    python src/backends.py tflite onnx
+
+and loaded with load_backend. TensorFlow, tf2onnx and onnxruntime are only
+imported by the backends and converters that need them.
+"""
+import abc
+import importlib.util
+import os
+import sys
+import threading
+from glob import glob
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from blockutils.logging import get_logger
+
+LOGGER = get_logger(__name__)
+
+# The runtimes a DSen2 model can be run with, keras runs the HDF5 model itself.
+RUNTIMES = ["keras", "savedmodel", "tflite", "onnx"]
+MODEL_SUFFIXES = {"savedmodel": ".savedmodel", "tflite": ".tflite", "onnx": ".onnx"}
+# Packages the runtimes need besides TensorFlow, to convert and to run the models.
+RUNTIME_PACKAGES = {"onnx": ["tf2onnx", "onnxruntime"]}
+ONNX_OPSET = 13
+# Post-training quantization tiers of the TFLite models, float32 is unquantized.
+PRECISIONS = ["float32", "float16", "dynamic", "int8"]
+
+# Number of threads of the TFLite and ONNX runtimes.
+INFERENCE_THREADS = os.cpu_count() or 1
+# NumPy types of the ONNX tensor types of the model inputs.
+ONNX_TYPES = {"tensor(float)": np.float32, "tensor(uint16)": np.uint16}
+
+
+def missing_packages(runtime: str) -> List[str]:
+    """Returns the packages that runtime needs and that are not installed."""
+    return [
+        package
+        for package in RUNTIME_PACKAGES.get(runtime, [])
+        if importlib.util.find_spec(package) is None
+    ]
+
+
+class Backend(abc.ABC):
+    """
+    Interface of the inference backends. predict takes the list of channel-first
+    float32 input batches of a DSen2 model and returns the channel-first float32
+    predictions, with the whole batch run at once unless batch_size is smaller.
+    Models with integer inputs (see integer_io_model) take and return uint16.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @abc.abstractmethod
+    def predict(self, inputs: List[np.ndarray], batch_size=None) -> np.ndarray:
+        pass
+
+
+class KerasBackend(Backend):
+    """Runs a loaded Keras model."""
+
+    def __init__(self, model):
+        super().__init__(model.name)
+        self.model = model
+
+    def predict(self, inputs: List[np.ndarray], batch_size=None) -> np.ndarray:
+        return self.model.predict(inputs, batch_size=batch_size or len(inputs[0]))
+
+
+class SavedModelBackend(Backend):
+    """Runs a SavedModel written by convert_model."""
+
+    def __init__(self, model_path: str):
+        # pylint: disable=import-outside-toplevel
+        import tensorflow as tf
+
+        super().__init__(Path(model_path).name)
+        self.tf = tf
+        self.model = tf.saved_model.load(model_path)
+
+    def predict(self, inputs: List[np.ndarray], batch_size=None) -> np.ndarray:
+        return self.model.serve(*[self.tf.constant(d) for d in inputs]).numpy()
+
+
+class TFLiteBackend(Backend):
+    """Runs a TFLite model written by convert_model. The input tensors are resized
+    to the shape of each batch."""
+
+    def __init__(self, model_path: str, num_threads: int = INFERENCE_THREADS):
+        # pylint: disable=import-outside-toplevel
+        import tensorflow as tf
+
+        super().__init__(Path(model_path).name)
+        self.interpreter = tf.lite.Interpreter(model_path, num_threads=num_threads)
+        # The inputs are named input_0, input_1, ... in the order of the model.
+        self.input_details = sorted(
+            self.interpreter.get_input_details(),
+            key=lambda detail: int(detail["name"].rsplit("_", 1)[-1].split(":")[0]),
+        )
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.shapes = None  # type: Optional[List[Tuple[int, ...]]]
+        self.lock = threading.Lock()
+
+    def predict(self, inputs: List[np.ndarray], batch_size=None) -> np.ndarray:
+        shapes = [d.shape for d in inputs]
+        with self.lock:
+            if shapes != self.shapes:
+                for detail, shape in zip(self.input_details, shapes):
+                    self.interpreter.resize_tensor_input(detail["index"], shape)
+                self.interpreter.allocate_tensors()
+                self.shapes = shapes
+            for detail, data in zip(self.input_details, inputs):
+                self.interpreter.set_tensor(
+                    detail["index"], np.ascontiguousarray(data, dtype=detail["dtype"])
+                )
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index)
+
+
+class OnnxBackend(Backend):
+    """Runs an ONNX model written by convert_model with onnxruntime."""
+
+    def __init__(self, model_path: str, num_threads: int = INFERENCE_THREADS):
+        try:
+            # pylint: disable=import-outside-toplevel
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx runtime needs onnxruntime installed.") from e
+
+        super().__init__(Path(model_path).name)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_types = [
+            (model_input.name, ONNX_TYPES[model_input.type])
+            for model_input in self.session.get_inputs()
+        ]
+
+    def predict(self, inputs: List[np.ndarray], batch_size=None) -> np.ndarray:
+        feed = {
+            name: np.ascontiguousarray(data, dtype=dtype)
+            for (name, dtype), data in zip(self.input_types, inputs)
+        }
+        return self.session.run(None, feed)[0]
+
+
+BACKENDS = {
+    "savedmodel": SavedModelBackend,
+    "tflite": TFLiteBackend,
+    "onnx": OnnxBackend,
+}
+
+
+def get_model_path(
+    model_filename: str,
+    runtime: str,
+    precision: str = "float32",
+    io_scale: Optional[float] = None,
+) -> str:
+    """Returns the path of the model of runtime and precision converted from
+    model_filename, with integer inputs and outputs if io_scale is given."""
+    suffix = MODEL_SUFFIXES[runtime]
+    if io_scale is not None:
+        suffix = f".uint16{suffix}"
+    if precision != "float32":
+        suffix = f".{precision}{suffix}"
+    return str(Path(model_filename).with_suffix(suffix))
+
+
+def integer_io_model(model, scale: float):
+    """
+    Wraps a Keras model into a model taking and returning uint16 inputs and
+    outputs. The inputs are divided by scale and the outputs are multiplied by
+    scale, rounded and clipped to the uint16 range inside the graph, so that the
+    raw data can be passed in and the predictions written out as they are.
+    """
+    # pylint: disable=import-outside-toplevel
+    import tensorflow as tf
+    from tensorflow import keras
+
+    inputs = [
+        keras.Input(model_input.shape[1:], dtype="uint16", name=f"uint16_{i}")
+        for i, model_input in enumerate(model.inputs)
+    ]
+    scaled = [
+        keras.layers.Lambda(lambda d: tf.cast(d, tf.float32) / scale)(model_input)
+        for model_input in inputs
+    ]
+    outputs = keras.layers.Lambda(
+        lambda d: tf.cast(tf.clip_by_value(tf.round(d * scale), 0, 65535), tf.uint16)
+    )(model(scaled))
+    return keras.Model(inputs, outputs, name=model.name)
+
+
+def _serving_function(model):
+    """Returns the inference function of a Keras model and its input signature,
+    with the inputs named input_0, input_1, ... and any batch and patch size."""
+    # pylint: disable=import-outside-toplevel
+    import tensorflow as tf
+
+    specs = [
+        tf.TensorSpec(
+            [None] + list(model_input.shape[1:]), model_input.dtype, f"input_{i}"
+        )
+        for i, model_input in enumerate(model.inputs)
+    ]
+    serve = tf.function(
+        lambda *inputs: model(list(inputs), training=False), input_signature=specs
+    )
+    return serve, specs
+
+
+def _quantize(converter, precision: str, calibration: Optional[List[np.ndarray]]):
+    """Sets up the post-training quantization of precision of a TFLite converter.
+    int8 quantizes the weights and activations, calibrated on the calibration
+    input batches, with float fallbacks for unsupported operations."""
+    # pylint: disable=import-outside-toplevel
+    import tensorflow as tf
+
+    if precision == "float32":
+        return
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif precision == "int8":
+        if calibration is None:
+            raise ValueError("int8 quantization needs calibration patches.")
+        converter.representative_dataset = lambda: (
+            [d[i : i + 1] for d in calibration] for i in range(len(calibration[0]))
+        )
+
+
+# pylint: disable=too-many-arguments
+def convert_model(
+    model_filename: str,
+    runtime: str,
+    model_path: Optional[str] = None,
+    precision: str = "float32",
+    calibration: Optional[List[np.ndarray]] = None,
+    io_scale: Optional[float] = None,
+) -> str:
+    """
+    Converts the HDF5 Keras model model_filename to a model of runtime, written to
+    model_path or next to the HDF5 file. Returns the path of the converted model.
+    TFLite models can be quantized to precision, int8 with calibration patches.
+    With io_scale, the model takes and returns uint16, see integer_io_model.
+    """
+    # pylint: disable=import-outside-toplevel
+    import tensorflow as tf
+    from tensorflow import keras
+    from tensorflow.python.framework.convert_to_constants import (
+        convert_variables_to_constants_v2,
+    )
+
+    if runtime not in BACKENDS:
+        raise ValueError(f"No converter for runtime {runtime}.")
+    if precision != "float32" and runtime != "tflite":
+        raise ValueError("Only the tflite runtime supports quantized models.")
+    if precision == "int8" and io_scale is not None:
+        # The int8 quantizer does not handle the uint16 casts of the outputs.
+        raise ValueError("int8 models do not support integer inputs and outputs.")
+    model_path = model_path or get_model_path(
+        model_filename, runtime, precision, io_scale
+    )
+    model = keras.models.load_model(model_filename, compile=False)
+    if io_scale is not None:
+        model = integer_io_model(model, io_scale)
+    serve, specs = _serving_function(model)
+    if runtime == "savedmodel":
+        module = tf.Module()
+        module.model = model
+        module.serve = serve
+        tf.saved_model.save(
+            module,
+            model_path,
+            signatures={"serving_default": serve.get_concrete_function()},
+        )
+    elif runtime == "tflite":
+        # The variables are frozen into constants, TFLite does not read them.
+        frozen = convert_variables_to_constants_v2(serve.get_concrete_function())
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([frozen])
+        _quantize(converter, precision, calibration)
+        Path(model_path).write_bytes(converter.convert())
+    else:
+        try:
+            # pylint: disable=import-outside-toplevel
+            import tf2onnx
+        except ImportError as e:
+            raise ImportError("Converting to ONNX needs tf2onnx installed.") from e
+        tf2onnx.convert.from_function(
+            serve, input_signature=specs, opset=ONNX_OPSET, output_path=model_path
+        )
+    LOGGER.info(f"Converted {model_filename} to {model_path}")
+    return model_path
+
+
+# pylint: disable=too-many-arguments
+def load_backend(
+    model_filename: str,
+    runtime: str,
+    num_threads: int = INFERENCE_THREADS,
+    precision: str = "float32",
+    calibration: Optional[List[np.ndarray]] = None,
+    io_scale: Optional[float] = None,
+) -> Backend:
+    """Loads the model of runtime and precision converted from the HDF5 model
+    model_filename, converting it first if there is no converted model yet."""
+    model_path = get_model_path(model_filename, runtime, precision, io_scale)
+    if not os.path.exists(model_path):
+        LOGGER.info(f"No {runtime} model at {model_path}, converting {model_filename}")
+        convert_model(
+            model_filename, runtime, model_path, precision, calibration, io_scale
+        )
+    if runtime == "savedmodel":
+        return SavedModelBackend(model_path)
+    return BACKENDS[runtime](model_path, num_threads)
+
+
+def accuracy_report(
+    expected: np.ndarray, predicted: np.ndarray, scale: float = 1.0
+) -> Dict[str, Any]:
+    """
+    Compares channel-first predictions of a quantized model with the predictions
+    of the float32 model: the RMSE overall and per band, in the units of the
+    outputs times scale, and the mean spectral angle (SAM) in degrees.
+    """
+    expected = expected.astype(np.float64)
+    predicted = predicted.astype(np.float64)
+    squared = ((predicted - expected) * scale) ** 2
+    dot = np.sum(expected * predicted, axis=1)
+    norms = np.linalg.norm(expected, axis=1) * np.linalg.norm(predicted, axis=1)
+    valid = norms > 0
+    angles = np.degrees(np.arccos(np.clip(dot[valid] / norms[valid], -1, 1)))
+    return {
+        "rmse": float(np.sqrt(squared.mean())),
+        "rmse_per_band": [float(v) for v in np.sqrt(squared.mean(axis=(0, 2, 3)))],
+        "sam_degrees": float(angles.mean()) if angles.size else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    # Converts all weights to the runtimes given as arguments, by default to all.
+    for weights in sorted(glob("weights/*.hdf5")):
+        for target in sys.argv[1:] or list(BACKENDS):
+            convert_model(weights, target)
@@ -0,0 +1,86 @@
+"""
+This module caches the opened raster data sets and their metadata, so that each
+subdataset of a SAFE product is only opened and parsed once per scene.
+"""
+import threading
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import rasterio
+from rasterio.crs import CRS
+from rasterio.io import DatasetReader
+from affine import Affine
+
+
+class DatasetMeta(NamedTuple):
+    width: int
+    height: int
+    band_count: int
+    transform: Affine
+    crs: Optional[CRS]
+    descriptions: Tuple[Optional[str], ...]
+    nodata: Optional[float]
+    profile: Dict
+
+
+class DatasetCache:
+    """
+    Keeps one open handle per data set and thread, and memoizes the metadata of
+    each data set. Use as a context manager to close all handles at the end of a
+    scene.
+
+    Examples:
+        >>> with DATASET_CACHE:
+        >>>     DATASET_CACHE.meta(ds10).width
+        10980
+    """
+
+    def __init__(self):
+        self.handles = {}  # type: Dict[Tuple[str, int], DatasetReader]
+        self.metas = {}  # type: Dict[str, DatasetMeta]
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def open(self, data: str) -> DatasetReader:
+        """
+        Returns an open handle of the data set. Handles are not shared between
+        threads since GDAL data sets must not be read concurrently.
+        """
+        key = (str(data), threading.get_ident())
+        with self.lock:
+            if key not in self.handles:
+                self.handles[key] = rasterio.open(data)
+                self.opened += 1
+            return self.handles[key]
+
+    def meta(self, data: str) -> DatasetMeta:
+        if str(data) not in self.metas:
+            d_s = self.open(data)
+            meta = DatasetMeta(
+                width=d_s.width,
+                height=d_s.height,
+                band_count=d_s.count,
+                transform=d_s.transform,
+                crs=d_s.crs,
+                descriptions=d_s.descriptions,
+                nodata=d_s.nodata,
+                profile=d_s.profile,
+            )
+            with self.lock:
+                self.metas[str(data)] = meta
+        return self.metas[str(data)]
+
+    def close(self):
+        with self.lock:
+            for d_s in self.handles.values():
+                d_s.close()
+            self.handles.clear()
+            self.metas.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+DATASET_CACHE = DatasetCache()
@@ -1,16 +1,21 @@
 import sys
 import os
 import gc
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Tuple
 
 import numpy as np
-import rasterio
 
 from blockutils.logging import get_logger
 from blockutils.common import load_params
-from blockutils.exceptions import UP42Error, SupportedErrors, catch_exceptions
+from blockutils.exceptions import catch_exceptions
 
-from s2_tiles_supres import Superresolution
-from supres import dsen2_20, dsen2_60
+from s2_tiles_supres import Superresolution, SR_BANDS, MIN_BLOCK_SIZE, NODATA
+from datasets import DATASET_CACHE
+from patches import TilePlan, RESOLUTION_FACTORS
+from supres import dsen2_20, dsen2_60, tune_patch_size, MODEL_REGISTRY, SCALE
+from writer import ResultWriter
 
 LOGGER = get_logger(__name__)
 
@@ -22,6 +27,8 @@ def save_result(
     valid_desc,
     output_profile,
     image_name,
+    compress="DEFLATE",
+    output_format="GTiff",
 ):
     """
     This method saves the feature collection meta data and the
@@ -32,55 +39,255 @@ def save_result(
         output_bands: The associated bands for the output image.
         valid_desc: The valid description of the existing bands.
         output_profile: The georeferencing for the output image.
-        output_features: The meta data for the output image.
         image_name: The name of the output image.
+        compress: The compression of the output image, one of writer.COMPRESSIONS.
+        output_format: The format of the output image, one of writer.OUTPUT_FORMATS.
     """
-
-    with rasterio.open(image_name, "w", **output_profile) as d_s:
-        for b_i, b_n in enumerate(output_bands):
-            d_s.write(model_output[:, :, b_i], indexes=b_i + 1)
-            d_s.set_band_description(b_i + 1, "SR " + valid_desc[b_n])
+    band_descriptions = ["SR " + valid_desc[b_n] for b_n in output_bands]
+    with ResultWriter(
+        image_name,
+        output_profile,
+        band_descriptions,
+        compress,
+        output_format=output_format,
+    ) as writer:
+        writer.write_image(model_output)
 
 
 class SuperresolutionProcess(Superresolution):
     # pylint: disable=too-many-locals
-    @staticmethod
-    def check_size(dims):
-        xmin, ymin, xmax, ymax = dims
-        if xmax < xmin or ymax < ymin:
-            raise UP42Error(
-                SupportedErrors.INPUT_PARAMETERS_ERROR,
-                "Invalid region of interest / UTM Zone combination",
+    def get_patch_sizes(self, plan, image_level, resolutions) -> Dict[str, Tuple]:
+        """
+        Returns the patch size and border of the models of resolutions. In the
+        auto_tune mode the patch sizes are benchmarked on the plan once and reused
+        for the following blocks, otherwise the configured sizes are used. Blocks
+        smaller than the tuned size, e.g. at the edge of the region in the streaming
+        mode, fall back to the configured size, which every block fits.
+        """
+        patch_sizes = {
+            resolution: (
+                self.params.__dict__[f"patch_size_{resolution}"],
+                self.params.__dict__[f"border_{resolution}"],
             )
+            for resolution in resolutions
+        }
+        if not self.params.__dict__["auto_tune"]:
+            return patch_sizes
+        for resolution in resolutions:
+            if resolution not in self.tuned_patch_sizes:
+                border = patch_sizes[resolution][1]
+                self.tuned_patch_sizes[resolution] = tune_patch_size(
+                    plan,
+                    resolution,
+                    image_level,
+                    border,
+                    self.memory_budget,
+                    runtime=self.params.__dict__["runtime"],
+                    precision=self.params.__dict__["model_precision"],
+                    integer_io=self.params.__dict__["integer_io"],
+                )
+            if self.tuned_patch_sizes[resolution] <= min(plan.shape[:2]):
+                patch_sizes[resolution] = (
+                    self.tuned_patch_sizes[resolution],
+                    patch_sizes[resolution][1],
+                )
+        return patch_sizes
 
-        if (xmax - xmin) < 192 or (ymax - ymin) < 192:
-            raise UP42Error(
-                SupportedErrors.INPUT_PARAMETERS_ERROR,
-                "AOI too small. Try again with a larger AOI (minimum pixel width or heigh of 192)",
+    def super_resolve(self, data, image_level, sr_indices, mask=None) -> np.ndarray:
+        """
+        Runs the DSen2 models needed for the requested output bands and returns the
+        super-resolved bands (and the original 10m bands if copy_original_bands is
+        set) as one channel-last uint16 array.
+
+        Args:
+            data: The 10m and 20m data, and the 60m data if any 60m band is requested.
+            image_level: The processing level of the image.
+            sr_indices: The indices of the requested bands in the outputs of the 20m
+                and the 60m model. A model is skipped if none of its bands is requested.
+            mask: The pixels of the data to super-resolve, e.g. of the AOI polygon.
+                The other pixels are nodata in the output.
+        """
+        data10, data20 = data[:2]
+        sr20_indices, sr60_indices = sr_indices
+        queue_depth = self.params.__dict__["prefetch_depth"]
+        sr_final = []
+        if self.params.__dict__["copy_original_bands"]:
+            sr_final.append(data10.astype(np.uint16))
+        # Both models cut their patches from the same padded and scaled inputs,
+        # padded with the largest border aligned to the coarsest grid. The models
+        # with integer_io scale the uint16 inputs themselves.
+        integer_io = self.params.__dict__["integer_io"]
+        resolutions = [r for r, i in zip(["20m", "60m"], sr_indices) if i]
+        factor = RESOLUTION_FACTORS[resolutions[-1]]
+        max_border = max(
+            self.params.__dict__[f"border_{resolution}"] for resolution in resolutions
+        )
+        plan = TilePlan(
+            data10,
+            data20,
+            data[2] if sr60_indices else None,
+            border=-(-max_border // factor) * factor,
+            scale=None if integer_io else SCALE,
+            nodata=(self.input_nodata, NODATA),
+            keep_dtype=integer_io,
+            mask=mask,
+        )
+        patch_sizes = self.get_patch_sizes(plan, image_level, resolutions)
+        # In the fused mode both models run concurrently on the shared plan, each
+        # with its own prefetch and mosaic threads and its share of the memory.
+        fused = self.params.__dict__["fused_models"] and len(resolutions) > 1
+        memory_budget = self.get_batch_budget(len(resolutions), fused)
+        models = {}
+        if sr60_indices:
+            models["60m"] = (
+                partial(dsen2_60, None, None, None, image_level, queue_depth, plan),
+                sr60_indices,
             )
+        if sr20_indices:
+            models["20m"] = (
+                partial(dsen2_20, None, None, image_level, queue_depth, plan),
+                sr20_indices,
+            )
+
+        def run_model(resolution):
+            LOGGER.info(f"Super-resolving the {resolution} data into 10m bands")
+            model, indices = models[resolution]
+            return model(
+                *patch_sizes[resolution],
+                memory_budget,
+                self.params.__dict__["runtime"],
+                self.params.__dict__["model_precision"],
+                integer_io,
+            )[:, :, indices]
+
+        if fused:
+            LOGGER.info("Running the 20m and 60m models concurrently")
+            with ThreadPoolExecutor(len(models)) as executor:
+                results = dict(zip(models, executor.map(run_model, models)))
+        else:
+            results = {resolution: run_model(resolution) for resolution in models}
+        sr_final.extend(results.pop(resolution) for resolution in resolutions)
+        sr_final = np.concatenate(sr_final, axis=2)
+        # The pixels without data in any 10m band are nodata in all output bands.
+        if plan.valid is not None:
+            sr_final[~plan.valid] = NODATA
+        del plan
+        return sr_final
+
+    # pylint: disable-msg=too-many-arguments
+    def stream_blocks(
+        self,
+        datasets,
+        dims,
+        image_level,
+        sr_indices,
+        output_profile,
+        output_desc,
+        filename,
+        executor=None,
+        mask=None,
+    ):
+        """
+        Super-resolves the region given by dims block by block. Each block is read
+        with an overlap to its neighbours, run through both models and its core is
+        written to the output straight away, so the peak memory is set by the
+        block size and not by the size of the region.
+
+        Args:
+            datasets: The (data set, validated indices, scale) of the resolutions
+                to read.
+            dims: The pixel bounds (xmin, ymin, xmax, ymax) of the region.
+            image_level: The processing level of the image.
+            sr_indices: The indices of the requested bands in the model outputs.
+            output_profile: The georeferencing for the output image.
+            output_desc: The band descriptions of the output image.
+            filename: The name of the output image.
+            executor: The thread pool to read the bands with.
+            mask: The pixels of the region to super-resolve. The blocks without
+                any of them are written as nodata without being read.
+        """
+        xmin, ymin, _, _ = dims
+        # Each block to read must hold at least one patch of both models.
+        min_size = max(
+            self.params.__dict__["patch_size_20m"],
+            self.params.__dict__["patch_size_60m"],
+            MIN_BLOCK_SIZE,
+        )
+        blocks = self.get_blocks(
+            *dims,
+            block_size=self.params.__dict__["block_size"],
+            min_size=-(-min_size // 6) * 6,
+        )
+        with ResultWriter(
+            filename,
+            output_profile,
+            output_desc,
+            self.params.__dict__["compression"],
+            output_format=self.params.__dict__["output_format"],
+        ) as writer:
+            for b_i, (read_bounds, core) in enumerate(blocks):
+                LOGGER.info(f"Super-resolving block {b_i + 1} of {len(blocks)}")
+                block_mask = None
+                if mask is not None:
+                    if not mask[
+                        core.row_off : core.row_off + core.height,
+                        core.col_off : core.col_off + core.width,
+                    ].any():
+                        LOGGER.info("The block is outside of the AOI, writing nodata")
+                        writer.write(
+                            np.full(
+                                (core.height, core.width, output_profile["count"]),
+                                NODATA,
+                                dtype=np.uint16,
+                            ),
+                            core,
+                        )
+                        continue
+                    block_mask = mask[
+                        read_bounds[1] - ymin : read_bounds[3] - ymin + 1,
+                        read_bounds[0] - xmin : read_bounds[2] - xmin + 1,
+                    ]
+                data = self.read_data(datasets, *read_bounds, executor)
+                sr_block = self.super_resolve(data, image_level, sr_indices, block_mask)
+                del data
+                row_off = core.row_off - (read_bounds[1] - ymin)
+                col_off = core.col_off - (read_bounds[0] - xmin)
+                writer.write(
+                    sr_block[
+                        row_off : row_off + core.height,
+                        col_off : col_off + core.width,
+                    ],
+                    core,
+                )
+                del sr_block
+                LOGGER.info("This is for releasing memory: %s", gc.collect())
 
     @catch_exceptions(LOGGER)
     def start(self, path_to_input_img, path_to_output_img):
+        # All raster data sets of the scene are opened once and closed at the end.
+        with DATASET_CACHE, ThreadPoolExecutor(self.read_threads) as executor:
+            self.process_scene(path_to_input_img, path_to_output_img, executor)
+        LOGGER.info(f"Model registry: {MODEL_REGISTRY.stats()}")
+
+    def process_scene(self, path_to_input_img, path_to_output_img, executor=None):
         data_list, image_level = self.get_data(path_to_input_img)
 
         for dsdesc in data_list:
             if "10m" in dsdesc:
-                if self.params.__dict__["clip_to_aoi"]:
-                    xmin, ymin, xmax, ymax, interest_area = self.area_of_interest(
-                        dsdesc
-                    )
-                else:
-                    # Get the pixel bounds of the full scene
-                    xmin, ymin, xmax, ymax, interest_area = self.get_max_min(
-                        0, 0, 20000, 20000, dsdesc
-                    )
+                xmin, ymin, xmax, ymax, interest_area = self.get_region(dsdesc)
                 LOGGER.info("Selected pixel region:")
                 LOGGER.info(f"xmin = {xmin}")
                 LOGGER.info(f"ymin = {ymin}")
                 LOGGER.info(f"xmax = {xmax}")
                 LOGGER.info(f"ymax = {ymax}")
                 LOGGER.info(f"The area of selected region = {interest_area}")
-            self.check_size(dims=(xmin, ymin, xmax, ymax))
+            self.check_size(
+                dims=(xmin, ymin, xmax, ymax),
+                min_size=max(
+                    self.params.__dict__["patch_size_20m"],
+                    self.params.__dict__["patch_size_60m"],
+                ),
+            )
 
         for dsdesc in data_list:
             if "10m" in dsdesc:
@@ -88,64 +295,94 @@ class SuperresolutionProcess(Superresolution):
                 validated_10m_bands, validated_10m_indices, dic_10m = self.validate(
                     dsdesc
                 )
-                data10 = self.data_final(
-                    dsdesc, validated_10m_indices, xmin, ymin, xmax, ymax, 1, 1
-                )
+                dataset10 = (dsdesc, validated_10m_indices, 1)
+                # Pixels with this value, or NODATA, in all 10m bands are nodata.
+                nodata = DATASET_CACHE.meta(dsdesc).nodata
+                self.input_nodata = NODATA if nodata is None else nodata
             if "20m" in dsdesc:
                 LOGGER.info("Selected 20m bands:")
                 validated_20m_bands, validated_20m_indices, dic_20m = self.validate(
                     dsdesc
                 )
-                data20 = self.data_final(
-                    dsdesc, validated_20m_indices, xmin, ymin, xmax, ymax, 1, 2
-                )
+                dataset20 = (dsdesc, validated_20m_indices, 2)
             if "60m" in dsdesc:
                 LOGGER.info("Selected 60m bands:")
                 validated_60m_bands, validated_60m_indices, dic_60m = self.validate(
                     dsdesc
                 )
-                data60 = self.data_final(
-                    dsdesc, validated_60m_indices, xmin, ymin, xmax, ymax, 1, 6
-                )
+                dataset60 = (dsdesc, validated_60m_indices, 6)
 
         validated_descriptions_all = {**dic_10m, **dic_20m, **dic_60m}
 
-        if validated_60m_bands and validated_20m_bands and validated_10m_bands:
-            LOGGER.info("Super-resolving the 60m data into 10m bands")
-            sr60_ = dsen2_60(data10, data20, data60, image_level)
-            sr60 = sr60_.astype(np.uint16)
-            del sr60_, data60
-            LOGGER.info("Super-resolving the 20m data into 10m bands")
-            sr20_ = dsen2_20(data10, data20, image_level)
-            sr20 = sr20_.astype(np.uint16)
-            del sr20_
+        output_bands = self.params.__dict__["output_bands"] or SR_BANDS
+        sr20_bands = [b for b in validated_20m_bands if b in output_bands]
+        sr60_bands = [b for b in validated_60m_bands if b in output_bands]
+        LOGGER.info(f"Requested output bands: {sr20_bands + sr60_bands}")
+        datasets = [dataset10, dataset20]
+        if sr60_bands:
+            datasets.append(dataset60)
         else:
+            LOGGER.info("No 60m band requested, skipping the 60m model")
+        if not sr20_bands:
+            LOGGER.info("No 20m band requested, skipping the 20m model")
+        sr_indices = (
+            [validated_20m_bands.index(b) for b in sr20_bands],
+            [validated_60m_bands.index(b) for b in sr60_bands],
+        )
+
+        if not (
+            (sr60_bands or sr20_bands) and validated_20m_bands and validated_10m_bands
+        ):
             LOGGER.info("No super-resolution performed, exiting")
-            sys.exit(0)
+            return
 
         if self.params.__dict__["copy_original_bands"]:
-            sr_final = np.concatenate((data10.astype(np.uint16), sr20, sr60), axis=2)
-            validated_sr_final_bands = (
-                validated_10m_bands + validated_20m_bands + validated_60m_bands
-            )
+            validated_sr_final_bands = validated_10m_bands + sr20_bands + sr60_bands
         else:
-            sr_final = np.concatenate((sr20, sr60), axis=2)
-            validated_sr_final_bands = validated_20m_bands + validated_60m_bands
+            validated_sr_final_bands = sr20_bands + sr60_bands
 
-        for dsdesc in data_list:
-            if "10m" in dsdesc:
-                p_r = self.update(dsdesc, data10.shape, sr_final, xmin, ymin)
+        size_10m = (ymax - ymin + 1, xmax - xmin + 1)
+        p_r = self.update(
+            dataset10[0], size_10m, len(validated_sr_final_bands), xmin, ymin
+        )
         filename = os.path.join(self.output_dir, path_to_output_img)
+        # Only the pixels of the AOI polygon are super-resolved with clip_to_aoi.
+        mask = self.aoi_mask(dataset10[0], (xmin, ymin, xmax, ymax))
+        if mask is not None:
+            LOGGER.info(f"{mask.mean():.1%} of the region is inside the AOI")
 
-        LOGGER.info("Now writing the super-resolved bands")
-        save_result(
-            sr_final,
-            validated_sr_final_bands,
-            validated_descriptions_all,
-            p_r,
-            filename,
-        )
-        del sr_final
+        if self.params.__dict__["streaming"]:
+            LOGGER.info("Super-resolving and writing the bands block by block")
+            self.stream_blocks(
+                datasets,
+                (xmin, ymin, xmax, ymax),
+                image_level,
+                sr_indices,
+                p_r,
+                [
+                    "SR " + validated_descriptions_all[b]
+                    for b in validated_sr_final_bands
+                ],
+                filename,
+                executor,
+                mask,
+            )
+        else:
+            data = self.read_data(datasets, xmin, ymin, xmax, ymax, executor)
+            sr_final = self.super_resolve(data, image_level, sr_indices, mask)
+            del data
+
+            LOGGER.info("Now writing the super-resolved bands")
+            save_result(
+                sr_final,
+                validated_sr_final_bands,
+                validated_descriptions_all,
+                p_r,
+                filename,
+                self.params.__dict__["compression"],
+                self.params.__dict__["output_format"],
+            )
+            del sr_final
         LOGGER.info("This is for releasing memory: %s", gc.collect())
         LOGGER.info("Writing the super-resolved bands is finished.")
 
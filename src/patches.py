@@ -1,15 +1,105 @@
-from math import ceil
+import os
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy as shallow_copy
 
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Sequence, Union
 
 import numpy as np
-from skimage.transform import resize
+from numpy.lib.stride_tricks import as_strided
+
+INTERP_THREADS = os.cpu_count() or 1
+INTERP_CHUNK_ROWS = 512
+
+# Default patch size and border (in 10m pixels) of the 20m and the 60m model.
+PATCH_SIZES = {"20m": (128, 8), "60m": (192, 12)}
+# Size of a pixel of the coarsest input of each model, in 10m pixels.
+RESOLUTION_FACTORS = {"20m": 2, "60m": 6}
+
+
+def check_patch_size(resolution: str, patch_size: int, border: int):
+    """Raises a ValueError if patches of patch_size with border do not align with
+    the grid of the coarsest input of the model of resolution."""
+    factor = RESOLUTION_FACTORS[resolution]
+    if not all(isinstance(value, int) for value in (patch_size, border)):
+        raise ValueError(f"The {resolution} patch size and border must be integers.")
+    if patch_size % factor or border % factor or border < 0:
+        raise ValueError(
+            f"The {resolution} patch size and border must be non-negative multiples "
+            f"of {factor}, got {patch_size} and {border}."
+        )
+    if patch_size - 2 * border < factor:
+        raise ValueError(
+            f"The {resolution} patch size must be larger than twice the border."
+        )
+
+
+def count_patches(
+    shape: Tuple[int, ...], resolution: str, patch_size: int, border: int
+) -> int:
+    """Returns the number of patches of patch_size with border that the model of
+    resolution predicts for an image of shape (in 10m pixels), as cut by
+    TilePlan.grids."""
+    factor = RESOLUTION_FACTORS[resolution]
+    core_lr = (patch_size - 2 * border) // factor
+    return (shape[0] // factor // core_lr + 1) * (shape[1] // factor // core_lr + 1)
+
+
+def _bilinear_indices(
+    in_size: int, out_size: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the two source indices and the weight of the second one for each
+    output pixel, with pixel-area aligned grids and mirrored borders as in
+    skimage.transform.resize(..., mode="reflect")."""
+    coords = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+    idx_0 = np.floor(coords).astype(int)
+    weight = (coords - idx_0).astype(np.float32)
+    idx_1 = idx_0 + 1
+    if in_size == 1:
+        return np.zeros_like(idx_0), np.zeros_like(idx_1), weight
+    period = 2 * (in_size - 1)
+    idx_0, idx_1 = [np.abs(idx) % period for idx in (idx_0, idx_1)]
+    idx_0, idx_1 = [
+        np.where(idx >= in_size, period - idx, idx) for idx in (idx_0, idx_1)
+    ]
+    return idx_0, idx_1, weight
+
+
+def interp_image(
+    image: np.ndarray, shape: Tuple[int, int], num_threads: int = INTERP_THREADS
+) -> np.ndarray:
+    """Upsample a whole (h, w, bands) image to shape with a bilinear kernel. The
+    bands and row chunks are interpolated in a thread pool. Returns float32."""
+    rows_0, rows_1, rows_w = _bilinear_indices(image.shape[0], shape[0])
+    cols_0, cols_1, cols_w = _bilinear_indices(image.shape[1], shape[1])
+    interp = np.empty(tuple(shape[:2]) + image.shape[2:3], dtype=np.float32)
+
+    def interp_chunk(band: int, row_start: int, row_stop: int):
+        rows = slice(row_start, row_stop)
+        src = image[:, :, band]
+        weight = rows_w[rows, np.newaxis]
+        tmp = src[rows_0[rows]] * (1 - weight) + src[rows_1[rows]] * weight
+        interp[rows, :, band] = tmp[:, cols_0] * (1 - cols_w) + tmp[:, cols_1] * cols_w
+
+    chunk = INTERP_CHUNK_ROWS
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = [
+            executor.submit(interp_chunk, band, row, min(row + chunk, shape[0]))
+            for band in range(image.shape[2])
+            for row in range(0, shape[0], chunk)
+        ]
+        for future in futures:
+            future.result()
+    return interp
 
 
 def interp_patches(
     image_20: np.ndarray, image_10_shape: Tuple[int, int, int, int]
 ) -> np.ndarray:
-    """Upsample patches to shape of higher resolution"""
+    """Upsample patches to shape of higher resolution. Slow reference
+    implementation of interp_image, one resize per patch and band."""
+    # pylint: disable=import-outside-toplevel
+    from skimage.transform import resize
+
     data20_interp = np.zeros((image_20.shape[0:2] + image_10_shape[2:4])).astype(
         np.float32
     )
@@ -22,24 +112,80 @@ def interp_patches(
     return data20_interp
 
 
-def get_patches(
+class PatchGrid:
+    """
+    Patches of an image as a strided view, without copying the image. Indexing
+    materializes only the selected patches, channels first, in the dtype of the
+    image, e.g. grid[0:128] returns an array of shape (128, bands, p, p).
+    """
+
+    def __init__(
+        self,
+        dset: np.ndarray,
+        patch_size: int,
+        range_i: np.ndarray,
+        range_j: np.ndarray,
+    ):
+        if patch_size > min(dset.shape[:2]):
+            raise ValueError(
+                f"Patches of {patch_size} do not fit an image of {dset.shape[:2]}."
+            )
+        # shape (i, j, bands, patch_size, patch_size), a read-only view on dset
+        stride_i, stride_j, stride_c = dset.strides
+        self.view = as_strided(
+            dset,
+            shape=(
+                dset.shape[0] - patch_size + 1,
+                dset.shape[1] - patch_size + 1,
+                dset.shape[2],
+                patch_size,
+                patch_size,
+            ),
+            strides=(stride_i, stride_j, stride_c, stride_i, stride_j),
+            writeable=False,
+        )
+        origins_i, origins_j = np.meshgrid(range_i, range_j, indexing="ij")
+        self.origins_i = origins_i.ravel()
+        self.origins_j = origins_j.ravel()
+        self.shape = (len(self.origins_i), dset.shape[2], patch_size, patch_size)
+        self.dtype = dset.dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, index) -> np.ndarray:
+        if not isinstance(index, tuple):
+            index = (index,)
+        patches = self.view[self.origins_i[index[0]], self.origins_j[index[0]]]
+        if np.ndim(self.origins_i[index[0]]):
+            return patches[(slice(None),) + index[1:]]
+        return patches[index[1:]]
+
+    # copy is part of the NumPy 2 protocol, the patches are always a new array.
+    # pylint: disable=unused-argument
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        patches = self[:]
+        return patches if dtype is None else patches.astype(dtype)
+
+    def select(self, indices: np.ndarray) -> "PatchGrid":
+        """Returns a PatchGrid of the patches at indices, on the same view."""
+        grid = shallow_copy(self)
+        grid.origins_i = self.origins_i[indices]
+        grid.origins_j = self.origins_j[indices]
+        grid.shape = (len(grid.origins_i),) + self.shape[1:]
+        return grid
+
+
+def get_patch_grid(
     dset: np.ndarray,
     patch_size: int,
     border: int,
     patches_along_i: int,
     patches_along_j: int,
-) -> np.ndarray:
-    n_bands = dset.shape[2]
-
-    # array index
-    nr_patches = (patches_along_i + 1) * (patches_along_j + 1)
+) -> PatchGrid:
     range_i = np.arange(0, patches_along_i) * (patch_size - 2 * border)
     range_j = np.arange(0, patches_along_j) * (patch_size - 2 * border)
 
-    patches = np.zeros((nr_patches, n_bands) + (patch_size, patch_size)).astype(
-        np.float32
-    )
-
     # if height and width are divisible by patch size - border * 2, or if
     # range_i \and range_j are smaller than size
     # add one extra patch at the end of the image
@@ -54,22 +200,172 @@ def get_patches(
     ):
         range_j = np.append(range_j, (dset.shape[1] - patch_size))
 
-    patch_count = 0
-    for ii in range_i.astype(int):
-        for jj in range_j.astype(int):
-            upper_left_i = ii
-            upper_left_j = jj
-            # make shape (p, c, w, h)
-            patches[patch_count] = crop_array_to_window(
-                dset,
-                get_crop_window(upper_left_i, upper_left_j, patch_size, 1),
-                rollaxis=True,
-            )
-            patch_count += 1
+    grid = PatchGrid(dset, patch_size, range_i.astype(int), range_j.astype(int))
     # array shape, ignore unsuscriptable
     # pylint: disable=unsubscriptable-object
-    assert patch_count == nr_patches == patches.shape[0]
-    return patches
+    assert len(grid) == (patches_along_i + 1) * (patches_along_j + 1)
+    return grid
+
+
+def get_patches(
+    dset: np.ndarray,
+    patch_size: int,
+    border: int,
+    patches_along_i: int,
+    patches_along_j: int,
+) -> np.ndarray:
+    """Returns all patches of the image as one array of shape (p, c, w, h) in the
+    dtype of the image."""
+    return get_patch_grid(dset, patch_size, border, patches_along_i, patches_along_j)[:]
+
+
+class TilePlan:
+    """
+    Tiling of one image for all models. The 10m, 20m and 60m inputs are mirrored
+    at the borders once, with the largest border of the models, the 20m and 60m
+    inputs are upsampled to 10m once, and optionally all are scaled to float32
+    once. The patch grids of each model are views on these shared buffers. With a
+    nodata value, or several, the patches without any valid 10m pixel can be left
+    out, e.g.
+
+        plan = TilePlan(d10, d20, d60, border=12, scale=SCALE, nodata=0)
+        p10, p20 = plan.grids(128, 8)
+        p10, p20, p60 = plan.grids(192, 12, with_60m=True)
+
+    With keep_dtype and no scale, the upsampled inputs are rounded back to the
+    dtype of the inputs, e.g. uint16 for the models with integer inputs. A mask of
+    the 10m pixels to super-resolve, e.g. of the AOI polygon, leaves out the
+    patches outside of it like the nodata patches.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        dset_10: np.ndarray,
+        dset_20: np.ndarray,
+        dset_60: Optional[np.ndarray] = None,
+        border: int = 12,
+        scale: Optional[float] = None,
+        interp: bool = True,
+        num_threads: int = INTERP_THREADS,
+        nodata: Optional[Union[float, Sequence[float]]] = None,
+        keep_dtype: bool = False,
+        mask: Optional[np.ndarray] = None,
+    ):
+        factors = [2, 6] if dset_60 is not None else [2]
+        if border % factors[-1]:
+            raise ValueError(
+                f"border must be a multiple of {factors[-1]}, got {border}."
+            )
+        self.shape = dset_10.shape
+        self.border = border
+        self.scale = scale
+        self.interp = interp
+        self.lr_shapes = [dset_20.shape]
+        # 10m pixels with data in any band, if nodata values are given, and in
+        # the mask, if a mask is given.
+        self.valid = None  # type: Optional[np.ndarray]
+        if nodata is not None:
+            data = np.ones(dset_10.shape, dtype=bool)
+            for value in np.unique(nodata):
+                data &= dset_10 != value
+            self.valid = data.any(axis=2)
+        if mask is not None:
+            self.valid = mask if self.valid is None else self.valid & mask
+
+        # Mirror the data at the borders to have the same dimensions as the input
+        dset_10 = np.pad(
+            dset_10, ((border, border), (border, border), (0, 0)), mode="symmetric"
+        )
+        self.buffers = [self._normalize(dset_10)]
+        lr_dsets = [dset_20] + ([dset_60] if dset_60 is not None else [])
+        for factor, dset in zip(factors, lr_dsets):
+            border_lr = border // factor
+            dset = np.pad(
+                dset,
+                ((border_lr, border_lr), (border_lr, border_lr), (0, 0)),
+                mode="symmetric",
+            )
+            if interp:
+                # Upsample the whole image once, the patches are cut from it.
+                upsampled = interp_image(
+                    dset, (dset_10.shape[0], dset_10.shape[1]), num_threads
+                )
+                if keep_dtype and self.scale is None:
+                    upsampled = np.rint(upsampled, out=upsampled).astype(dset.dtype)
+                self.buffers.append(self._normalize(upsampled, inplace=True))
+            else:
+                self.buffers.append(self._normalize(dset))
+        if dset_60 is not None:
+            self.lr_shapes.append(dset_60.shape)
+
+    def _normalize(self, dset: np.ndarray, inplace: bool = False) -> np.ndarray:
+        if self.scale is None:
+            return dset
+        if inplace and dset.dtype == np.float32:
+            dset /= np.float32(self.scale)
+            return dset
+        return dset.astype(np.float32) / np.float32(self.scale)
+
+    def grids(self, patch_size: int, border: int, with_60m: bool = False):
+        """
+        Returns the patch grids of the 10m, 20m and, with with_60m, 60m inputs for
+        patches of patch_size (in 10m pixels) with border. The patches are counted
+        along the coarsest of the used resolutions, as in the training of the models.
+        """
+        factors = [1, 2, 6] if with_60m else [1, 2]
+        if len(factors) > len(self.buffers):
+            raise ValueError("The plan has no 60m data.")
+        if border > self.border:
+            raise ValueError(f"border must be at most {self.border}, got {border}.")
+        offset = self.border - border
+        if any(offset % factor or border % factor for factor in factors):
+            raise ValueError(
+                f"border and the border of the plan must be multiples of {factors[-1]}."
+            )
+
+        factor = factors[-1]
+        core_lr = (patch_size - 2 * border) // factor
+        patches_along_i = self.lr_shapes[len(factors) - 2][0] // core_lr
+        patches_along_j = self.lr_shapes[len(factors) - 2][1] // core_lr
+
+        grids = []
+        for i, buffer in enumerate(self.buffers[: len(factors)]):
+            factor = 1 if i == 0 or self.interp else factors[i]
+            cut = offset // factor
+            view = buffer[cut : buffer.shape[0] - cut, cut : buffer.shape[1] - cut]
+            grids.append(
+                get_patch_grid(
+                    view,
+                    patch_size // factor,
+                    border // factor,
+                    patches_along_i,
+                    patches_along_j,
+                )
+            )
+        return tuple(grids)
+
+    def valid_patches(self, grid: PatchGrid, patch_size: int, border: int):
+        """
+        Returns the indices of the patches of grid, of patch_size with border, whose
+        core has at least one valid 10m pixel, or None if the plan has no nodata
+        value. The origins of the grid are the origins of the cores in the image.
+        """
+        if self.valid is None:
+            return None
+        core = patch_size - 2 * border
+        valid_rows = {
+            y: np.concatenate([[0], np.cumsum(self.valid[y : y + core].any(axis=0))])
+            for y in np.unique(grid.origins_i)
+        }
+        counts = np.array(
+            [
+                valid_rows[y][x + core] - valid_rows[y][x]
+                for y, x in zip(grid.origins_i, grid.origins_j)
+            ],
+            dtype=int,
+        )
+        return np.flatnonzero(counts)
 
 
 def get_test_patches(
@@ -78,49 +374,14 @@ def get_test_patches(
     patch_size: int = 128,
     border: int = 4,
     interp: bool = True,
-) -> Tuple[np.ndarray, np.ndarray]:
-    """Used for inference. Creates patches of specific size in the whole image (10m and 20m)"""
-
-    patch_size_lr = patch_size // 2
-    border_lr = border // 2
-
-    # Mirror the data at the borders to have the same dimensions as the input
-    dset_10 = np.pad(
-        dset_10,
-        ((border, border), (border, border), (0, 0)),
-        mode="symmetric",
-    )
-    dset_20 = np.pad(
-        dset_20,
-        ((border_lr, border_lr), (border_lr, border_lr), (0, 0)),
-        mode="symmetric",
+) -> Tuple[PatchGrid, PatchGrid]:
+    """Used for inference. Creates patches of specific size in the whole image (10m and 20m).
+    The 10m patches are a PatchGrid on the padded input, in its original dtype."""
+    return TilePlan(dset_10, dset_20, border=border, interp=interp).grids(
+        patch_size, border
     )
 
-    patches_along_i = (dset_20.shape[0] - 2 * border_lr) // (
-        patch_size_lr - 2 * border_lr
-    )
-    patches_along_j = (dset_20.shape[1] - 2 * border_lr) // (
-        patch_size_lr - 2 * border_lr
-    )
 
-    image_10 = get_patches(
-        dset_10, patch_size, border, patches_along_i, patches_along_j
-    )
-    image_20 = get_patches(
-        dset_20, patch_size_lr, border_lr, patches_along_i, patches_along_j
-    )
-
-    image_10_shape = image_10.shape
-
-    if interp:
-        data20_interp = interp_patches(image_20, image_10_shape)
-    else:
-        data20_interp = image_20
-    return image_10, data20_interp
-
-
-# Complex method
-# pylint: disable=too-many-locals
 def get_test_patches60(
     dset_10: np.ndarray,
     dset_20: np.ndarray,
@@ -128,60 +389,13 @@ def get_test_patches60(
     patch_size: int = 192,
     border: int = 12,
     interp: bool = True,
-) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Used for inference. Creates patches of specific size in the whole image (10m, 20m and 60m)"""
-
-    patch_size_20 = patch_size // 2
-    patch_size_60 = patch_size // 6
-    border_20 = border // 2
-    border_60 = border // 6
-
-    # Mirror the data at the borders to have the same dimensions as the input
-    dset_10 = np.pad(
-        dset_10,
-        ((border, border), (border, border), (0, 0)),
-        mode="symmetric",
-    )
-    dset_20 = np.pad(
-        dset_20,
-        ((border_20, border_20), (border_20, border_20), (0, 0)),
-        mode="symmetric",
-    )
-    dset_60 = np.pad(
-        dset_60,
-        ((border_60, border_60), (border_60, border_60), (0, 0)),
-        mode="symmetric",
+) -> Tuple[PatchGrid, PatchGrid, PatchGrid]:
+    """Used for inference. Creates patches of specific size in the whole image (10m, 20m and 60m).
+    The 10m patches are a PatchGrid on the padded input, in its original dtype."""
+    return TilePlan(dset_10, dset_20, dset_60, border=border, interp=interp).grids(
+        patch_size, border, with_60m=True
     )
 
-    patches_along_i = (dset_60.shape[0] - 2 * border_60) // (
-        patch_size_60 - 2 * border_60
-    )
-    patches_along_j = (dset_60.shape[1] - 2 * border_60) // (
-        patch_size_60 - 2 * border_60
-    )
-
-    image_10 = get_patches(
-        dset_10, patch_size, border, patches_along_i, patches_along_j
-    )
-    image_20 = get_patches(
-        dset_20, patch_size_20, border_20, patches_along_i, patches_along_j
-    )
-    image_60 = get_patches(
-        dset_60, patch_size_60, border_60, patches_along_i, patches_along_j
-    )
-
-    image_10_shape = image_10.shape
-
-    if interp:
-        data20_interp = interp_patches(image_20, image_10_shape)
-        data60_interp = interp_patches(image_60, image_10_shape)
-
-    else:
-        data20_interp = image_20
-        data60_interp = image_60
-
-    return image_10, data20_interp, data60_interp
-
 
 def get_crop_window(
     upper_left_x: int, upper_left_y: int, patch_size: int, scale: int = 1
@@ -215,42 +429,98 @@ def crop_array_to_window(
         return cropped_array
 
 
+def get_tile_origins(
+    size: Tuple[int, ...], patch_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the row and column of the upper left corner of each tile of
+    patch_size in an image of size, in the order of recompose_images. As in
+    get_patch_grid, there are size // patch_size tiles along each axis and one
+    more at the end of the image, which repeats the last one if patch_size
+    divides size."""
+    ypoints = np.append(
+        np.arange(size[0] // patch_size) * patch_size, size[0] - patch_size
+    )
+    xpoints = np.append(
+        np.arange(size[1] // patch_size) * patch_size, size[1] - patch_size
+    )
+    origins_y, origins_x = np.meshgrid(ypoints, xpoints, indexing="ij")
+    return origins_y.ravel(), origins_x.ravel()
+
+
+class Mosaic:
+    """
+    Channel-last output image that predicted patches are written into as soon as
+    each batch arrives. The cores of the patches are scaled, clipped to the range
+    of dtype and cast on the fly, so no float image of the full size is built.
+    With the number of bands, the image is allocated up front, otherwise with
+    the first batch. With min_value, the predictions are clipped to at least
+    min_value, e.g. 1 to keep them apart from a nodata value of 0.
+
+    The tile origins of a PatchGrid on an image padded by border are the origins
+    of the patch cores in the output image, e.g.
+    Mosaic(size, border, grid.origins_i, grid.origins_j, scale=SCALE).
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        size: Tuple[int, ...],
+        border: int,
+        origins_y: np.ndarray,
+        origins_x: np.ndarray,
+        scale: float = 1.0,
+        dtype=np.uint16,
+        bands: Optional[int] = None,
+        min_value: Optional[int] = None,
+    ):
+        self.size = size[:2]
+        self.border = border
+        self.origins_y = origins_y
+        self.origins_x = origins_x
+        self.scale = scale
+        self.dtype = np.dtype(dtype)
+        self.min_value = min_value
+        self.image = None  # type: Optional[np.ndarray]
+        if bands is not None:
+            self.image = np.zeros(self.size + (bands,), dtype=self.dtype)
+        self.next_patch = 0
+
+    def add(self, predictions: np.ndarray):
+        """Writes a batch of predicted patches, shape (n, bands, p, p), following
+        the patches added before."""
+        border = self.border
+        cores = predictions[
+            :,
+            :,
+            border : predictions.shape[2] - border,
+            border : predictions.shape[3] - border,
+        ]
+        if self.scale != 1:
+            cores = cores * self.scale
+        if np.issubdtype(self.dtype, np.integer) and cores.dtype != self.dtype:
+            info = np.iinfo(self.dtype)
+            low = info.min if self.min_value is None else self.min_value
+            cores = np.clip(cores, low, info.max)
+        elif self.min_value is not None:
+            cores = np.maximum(cores, np.asarray(self.min_value, dtype=cores.dtype))
+        # (n, p, p, bands), cast once for the whole batch
+        cores = cores.transpose(0, 2, 3, 1).astype(self.dtype, copy=False)
+        if self.image is None:
+            self.image = np.zeros(self.size + (cores.shape[3],), dtype=self.dtype)
+        core_h, core_w = cores.shape[1:3]
+        for patch in range(cores.shape[0]):
+            y = self.origins_y[self.next_patch]
+            x = self.origins_x[self.next_patch]
+            self.image[y : y + core_h, x : x + core_w] = cores[patch]
+            self.next_patch += 1
+
+
 def recompose_images(a: np.ndarray, border: int, size=None) -> np.ndarray:
     """ From array with patches recompose original image."""
     if a.shape[0] == 1:
-        images = a[0]
-    else:
-        # # This is done because we do not mirror the data at the image border
-        # size = [s - border * 2 for s in size]
-        patch_size = a.shape[2] - border * 2
-
-        # print('Patch has dimension {}'.format(patch_size))
-        # print('Prediction has shape {}'.format(a.shape))
-        x_tiles = int(ceil(size[1] / float(patch_size)))
-        y_tiles = int(ceil(size[0] / float(patch_size)))
-        # print('Tiles per image {} {}'.format(x_tiles, y_tiles))
-
-        # Initialize image
-        # print('Image size is: {}'.format(size))
-        images = np.zeros((a.shape[1], size[0], size[1])).astype(np.float32)
-
-        current_patch = 0
-        for y in range(0, y_tiles):
-            ypoint = y * patch_size
-            if ypoint > size[0] - patch_size:
-                ypoint = size[0] - patch_size
-            for x in range(0, x_tiles):
-                xpoint = x * patch_size
-                if xpoint > size[1] - patch_size:
-                    xpoint = size[1] - patch_size
-                images[
-                    :, ypoint : ypoint + patch_size, xpoint : xpoint + patch_size
-                ] = a[
-                    current_patch,
-                    :,
-                    border : a.shape[2] - border,
-                    border : a.shape[3] - border,
-                ]
-                current_patch += 1
-
-    return images.transpose((1, 2, 0))
+        return a[0].transpose((1, 2, 0))
+    origins_y, origins_x = get_tile_origins(size, a.shape[2] - border * 2)
+    mosaic = Mosaic(size, border, origins_y, origins_x, dtype=np.float32)
+    mosaic.add(a[: len(origins_y)])
+    assert mosaic.image is not None
+    return mosaic.image
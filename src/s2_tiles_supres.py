@@ -3,11 +3,14 @@ This module is the main script for creating super-resolution spectral bands from
 """
 import re
 import os
+import gc
 import json
 from collections import defaultdict
+from functools import lru_cache
 import subprocess
 
-from typing import List, Tuple
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from pathlib import Path
 import glob
 import warnings
@@ -15,24 +18,85 @@ import warnings
 import numpy as np
 from geojson import FeatureCollection
 import rasterio
+from rasterio.features import rasterize
 from rasterio.windows import Window
 from rasterio import Affine as A
 import pyproj as proj
+import shapely
+from shapely.geometry import shape
 from blockutils.blocks import ProcessingBlock
 from blockutils.logging import get_logger
 from blockutils.common import load_metadata
 from blockutils.stac import STACQuery
 from blockutils.exceptions import UP42Error, SupportedErrors
 
+from backends import PRECISIONS, RUNTIMES, missing_packages
+from datasets import DATASET_CACHE
+from patches import PATCH_SIZES, RESOLUTION_FACTORS, check_patch_size, count_patches
+from scene_cache import SceneCache
+from supres import BATCH_SIZE, estimate_batch_memory, get_batch_size
+from writer import COMPRESSIONS, OUTPUT_FORMATS
+
 
 warnings.filterwarnings(action="ignore", category=FutureWarning)
 LOGGER = get_logger(__name__)
 
+# Default size and overlap (in 10m pixels) of the blocks of the streaming mode.
+# Both are multiples of 6 so that the blocks are aligned to the 60m grid.
+BLOCK_SIZE = 3660
+BLOCK_OVERLAP = 96
+MIN_BLOCK_SIZE = 192
+
+# The bands super-resolved by the 20m and the 60m model.
+SR_BANDS = ["B5", "B6", "B7", "B8A", "B11", "B12", "B1", "B9"]
+
+# Nodata value of the input bands without a nodata value and of the output image.
+NODATA = 0
+
+# Number of threads decoding the JPEG2000 bands, unless read_threads is set.
+READ_THREADS = os.cpu_count() or 1
+
+# Memory limit files of the cgroup v2 and v1 hierarchies.
+CGROUP_MEMORY_LIMITS = [
+    "/sys/fs/cgroup/memory.max",
+    "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+]
+
+
+def get_memory_limit(cgroup_files: Optional[List[str]] = None) -> int:
+    """Returns the memory (in bytes) available to the process: the physical memory,
+    or the memory limit of the container's cgroup if it is lower."""
+    limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for cgroup_file in CGROUP_MEMORY_LIMITS if cgroup_files is None else cgroup_files:
+        try:
+            with open(cgroup_file) as src:
+                value = src.read().strip()
+        except OSError:
+            continue
+        # "max" (v2) or a value above the physical memory (v1) means no limit.
+        if value.isdigit():
+            limit = min(limit, int(value))
+    return limit
+
+
+# Default memory budget (in bytes) of the auto-tune mode, half of the memory
+# available to the container.
+MEMORY_BUDGET = get_memory_limit() // 2
+
 # This code is adapted from this repository
 # https://github.com/lanha/DSen2 and is distributed under the same
 # license.
 
 
+@lru_cache(maxsize=None)
+def get_transformer(crs: str) -> proj.Transformer:
+    """
+    Returns the transformer from WGS 84 longitudes and latitudes to crs, created
+    once per CRS.
+    """
+    return proj.Transformer.from_crs("epsg:4326", crs, always_xy=True)
+
+
 class Superresolution(ProcessingBlock):
     """
     This class implements a CNN model to obtain a high resolution (10m)
@@ -53,9 +117,29 @@ class Superresolution(ProcessingBlock):
             data_folder: The original image file.
         """
 
-        params = STACQuery.from_dict(params, lambda x: True)
+        if not isinstance(params, STACQuery):
+            params = STACQuery.from_dict(params, lambda x: True)
         params.set_param_if_not_exists("copy_original_bands", False)
         params.set_param_if_not_exists("clip_to_aoi", False)
+        params.set_param_if_not_exists("in_process", False)
+        params.set_param_if_not_exists("streaming", False)
+        params.set_param_if_not_exists("block_size", BLOCK_SIZE)
+        params.set_param_if_not_exists("compression", "DEFLATE")
+        params.set_param_if_not_exists("output_format", "GTiff")
+        params.set_param_if_not_exists("read_threads", None)
+        params.set_param_if_not_exists("output_bands", None)
+        params.set_param_if_not_exists("scene_cache_dir", None)
+        params.set_param_if_not_exists("scene_cache_size_gb", 50)
+        params.set_param_if_not_exists("prefetch_depth", 2)
+        for resolution, (patch_size, border) in PATCH_SIZES.items():
+            params.set_param_if_not_exists(f"patch_size_{resolution}", patch_size)
+            params.set_param_if_not_exists(f"border_{resolution}", border)
+        params.set_param_if_not_exists("auto_tune", False)
+        params.set_param_if_not_exists("runtime", "keras")
+        params.set_param_if_not_exists("model_precision", "float32")
+        params.set_param_if_not_exists("memory_budget_gb", None)
+        params.set_param_if_not_exists("fused_models", False)
+        params.set_param_if_not_exists("integer_io", False)
 
         self.params = params
 
@@ -63,6 +147,20 @@ class Superresolution(ProcessingBlock):
         self.input_dir = input_dir
         self.data_folder = data_folder
 
+        self.product_id = ""
+        self.input_nodata = NODATA
+        self.tuned_patch_sizes = {}  # type: Dict[str, int]
+        self.read_threads = params.__dict__["read_threads"] or READ_THREADS
+        self.memory_budget = MEMORY_BUDGET
+        if params.__dict__["memory_budget_gb"]:
+            self.memory_budget = int(params.__dict__["memory_budget_gb"] * 1024 ** 3)
+        self.scene_cache = None  # type: Optional[SceneCache]
+        if params.__dict__["scene_cache_dir"]:
+            self.scene_cache = SceneCache(
+                params.__dict__["scene_cache_dir"],
+                int(params.__dict__["scene_cache_size_gb"] * 1024 ** 3),
+            )
+
     @classmethod
     def from_dict(cls, kwargs):
         """
@@ -106,8 +204,8 @@ class Superresolution(ProcessingBlock):
         # The following line will define whether image is L1C or L2A
         # For instance image_level can be "MSIL1C" or "MSIL2A"
         image_level = Path(data_path).stem.split("_")[1]
-        raster_data = rasterio.open(data_path)
-        datasets = raster_data.subdatasets
+        self.product_id = Path(data_path).parent.name
+        datasets = DATASET_CACHE.open(data_path).subdatasets
 
         return datasets, image_level
 
@@ -123,9 +221,8 @@ class Superresolution(ProcessingBlock):
             (0, 0, 395, 395, 156816)
 
         """
-        with rasterio.open(data) as d_s:
-            d_width = d_s.width
-            d_height = d_s.height
+        d_width = DATASET_CACHE.meta(data).width
+        d_height = DATASET_CACHE.meta(data).height
 
         tmxmin = max(min(x_1, x_2, d_width - 1), 0)
         tmxmax = min(max(x_1, x_2, 0), d_width - 1)
@@ -140,29 +237,26 @@ class Superresolution(ProcessingBlock):
         return tmxmin, tmymin, tmxmax, tmymax, area
 
     # pylint: disable-msg=too-many-locals
-    def to_xy(self, lon: float, lat: float, data) -> Tuple:
+    def to_xy(self, lon, lat, data) -> Tuple:
         """
         This method gets the longitude and the latitude of a given point and projects it
-        into pixel location in the new coordinate system.
+        into pixel location in the new coordinate system. Arrays of points are
+        projected in one call.
 
         Args:
-            lon: The longitude of a chosen point
-            lat: The longitude of a chosen point
+            lon: The longitude of a chosen point, or an array of longitudes
+            lat: The longitude of a chosen point, or an array of latitudes
 
         Returns:
             The pixel location in the coordinate system of the input image
         """
         # get the image's coordinate system.
-        with rasterio.open(data) as d_s:
-            coor = d_s.transform
+        coor = DATASET_CACHE.meta(data).transform
         a_t, b_t, xoff, d_t, e_t, yoff = [coor[x] for x in range(6)]
 
         # transform the lat and lon into x and y position which are defined in
         # the world's coordinate system.
-        local_crs = self.get_utm(data)
-        crs_wgs = proj.Proj(init="epsg:4326")  # WGS 84 geographic coordinate system
-        crs_bng = proj.Proj(init=local_crs)  # use a locally appropriate projected CRS
-        x_p, y_p = proj.transform(crs_wgs, crs_bng, lon, lat)
+        x_p, y_p = get_transformer(self.get_utm(data)).transform(lon, lat)
         x_p -= xoff
         y_p -= yoff
 
@@ -171,6 +265,8 @@ class Superresolution(ProcessingBlock):
         det_inv = 1.0 / (a_t * e_t - d_t * b_t)
         x_n = (e_t * x_p - b_t * y_p) * det_inv
         y_n = (-d_t * x_p + a_t * y_p) * det_inv
+        if np.ndim(x_n):
+            return x_n.astype(int), y_n.astype(int)
         return int(x_n), int(y_n)
 
     @staticmethod
@@ -184,23 +280,73 @@ class Superresolution(ProcessingBlock):
         Returns:
             UTM of the selected raster file.
         """
-        with rasterio.open(data) as d_s:
-            data_crs = d_s.crs.to_dict()
-        utm = data_crs["init"]
+        data_crs = DATASET_CACHE.meta(data).crs
+        utm = f"epsg:{data_crs.to_epsg()}"
         return utm
 
     # pylint: disable-msg=too-many-locals
     def area_of_interest(self, data):
         """
         This method returns the coordinates that define the desired area of interest.
+        All the vertices of the AOI geometry are projected, so that the region
+        covers the whole AOI even if it is rotated in the image's coordinate system.
         """
-
-        roi_lon1, roi_lat1, roi_lon2, roi_lat2 = self.params.bounds()
-        x_1, y_1 = self.to_xy(roi_lon1, roi_lat1, data)
-        x_2, y_2 = self.to_xy(roi_lon2, roi_lat2, data)
-        xmi, ymi, xma, yma, area = self.get_max_min(x_1, y_1, x_2, y_2, data)
+        vertices = shapely.get_coordinates(shape(self.params.geometry()))
+        x_s, y_s = self.to_xy(vertices[:, 0], vertices[:, 1], data)
+        xmi, ymi, xma, yma, area = self.get_max_min(
+            x_s.min(), y_s.min(), x_s.max(), y_s.max(), data
+        )
         return xmi, ymi, xma, yma, area
 
+    def aoi_mask(self, data, dims: Tuple[int, int, int, int]) -> Optional[np.ndarray]:
+        """
+        This method returns the mask of the 10m pixels of the region given by dims
+        that touch the AOI polygon, or None if clip_to_aoi is not set. The patches
+        without any pixel in the mask are not super-resolved.
+        """
+        if not self.params.__dict__["clip_to_aoi"]:
+            return None
+        transformer = get_transformer(self.get_utm(data))
+        polygon = shapely.transform(
+            shape(self.params.geometry()),
+            lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])),
+        )
+        xmin, ymin, xmax, ymax = dims
+        mask = rasterize(
+            [polygon],
+            out_shape=(ymax - ymin + 1, xmax - xmin + 1),
+            transform=DATASET_CACHE.meta(data).transform * A.translation(xmin, ymin),
+            all_touched=True,
+            dtype=np.uint8,
+        )
+        return mask.astype(bool)
+
+    def get_region(self, data) -> Tuple:
+        """
+        This method returns the pixel bounds and the area of the region to
+        super-resolve in the 10m raster file: the area of interest if clip_to_aoi
+        is set, otherwise the full scene.
+        """
+        if self.params.__dict__["clip_to_aoi"]:
+            return self.area_of_interest(data)
+        # Get the pixel bounds of the full scene
+        return self.get_max_min(0, 0, 20000, 20000, data)
+
+    @staticmethod
+    def check_size(dims, min_size=PATCH_SIZES["60m"][0]):
+        xmin, ymin, xmax, ymax = dims
+        if xmax < xmin or ymax < ymin:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                "Invalid region of interest / UTM Zone combination",
+            )
+
+        if (xmax - xmin) < min_size or (ymax - ymin) < min_size:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"AOI too small. Try again with a larger AOI (minimum pixel width or heigh of {min_size})",
+            )
+
     @staticmethod
     def validate_description(description: str) -> str:
         """
@@ -268,15 +414,15 @@ class Superresolution(ProcessingBlock):
         validated_bands = []  # type: list
         validated_indices = []  # type: list
         validated_descriptions = defaultdict(str)  # type: defaultdict
-        with rasterio.open(data) as d_s:
-            for i in range(0, d_s.count):
-                desc = self.validate_description(d_s.descriptions[i])
-                name = self.get_band_short_name(desc)
-                if name in select_bands:
-                    select_bands.remove(name)
-                    validated_bands += [name]
-                    validated_indices += [i]
-                    validated_descriptions[name] = desc
+        descriptions = DATASET_CACHE.meta(data).descriptions
+        for i, description in enumerate(descriptions):
+            desc = self.validate_description(description)
+            name = self.get_band_short_name(desc)
+            if name in select_bands:
+                select_bands.remove(name)
+                validated_bands += [name]
+                validated_indices += [i]
+                validated_descriptions[name] = desc
         return validated_bands, validated_indices, validated_descriptions
 
     @staticmethod
@@ -290,6 +436,8 @@ class Superresolution(ProcessingBlock):
         to specify the area of interest.
         Then it returns an numpy array of values
         for all the pixels inside the area of interest.
+        Only the selected bands are decoded, straight into
+        a contiguous channel-last array.
         :param data: The raster file for a specific resolution.
         :param term: The validate indices of the
         bands obtained from the validate method.
@@ -297,21 +445,183 @@ class Superresolution(ProcessingBlock):
         """
         if term:
             LOGGER.info(term)
-            with rasterio.open(data) as d_s:
-                d_final = np.rollaxis(
-                    d_s.read(
-                        window=Window(
-                            col_off=x_mi // scale,
-                            row_off=y_mi // scale,
-                            width=(x_ma - x_mi + n_res) // scale,
-                            height=(y_ma - y_mi + n_res) // scale,
-                        )
-                    ),
-                    0,
-                    3,
-                )[:, :, term]
+            window = Superresolution.get_window(x_mi, y_mi, x_ma, y_ma, n_res, scale)
+            d_final = Superresolution.allocate_bands(data, term, window)
+            DATASET_CACHE.open(data).read(
+                [index + 1 for index in term],
+                window=window,
+                out=d_final.transpose(2, 0, 1),
+            )
         return d_final
 
+    @staticmethod
+    def allocate_bands(data, term: List, window: Window) -> np.ndarray:
+        """
+        This method returns an empty channel-last array for the selected bands of
+        the raster file inside the window.
+        """
+        return np.empty(
+            (int(window.height), int(window.width), len(term)),
+            dtype=DATASET_CACHE.meta(data).profile["dtype"],
+        )
+
+    @staticmethod
+    # pylint: disable-msg=too-many-arguments
+    def get_window(
+        x_mi: int, y_mi: int, x_ma: int, y_ma: int, n_res: int, scale: int
+    ) -> Window:
+        """
+        This method returns the window of the area of interest given by the output
+        of get_max_min in a raster file with the given scale to the 10m bands.
+        """
+        return Window(
+            col_off=x_mi // scale,
+            row_off=y_mi // scale,
+            width=(x_ma - x_mi + n_res) // scale,
+            height=(y_ma - y_mi + n_res) // scale,
+        )
+
+    @staticmethod
+    def read_band(
+        data, index: int, window: Window, out: np.ndarray, gdal_threads: int = 1
+    ):
+        """
+        This method reads one band of the raster file into out, decoding it with the
+        given number of GDAL threads. Each thread reads through its own dataset
+        handle.
+        """
+        with rasterio.Env(GDAL_NUM_THREADS=gdal_threads):
+            DATASET_CACHE.open(data).read(index + 1, window=window, out=out)
+
+    def read_cached_band(
+        self, data, index: int, window: Window, out: np.ndarray, gdal_threads: int = 1
+    ):
+        """
+        This method copies the window of one band into out from the scene cache.
+        The first time the band is requested, the whole band is decoded and cached.
+        """
+        meta = DATASET_CACHE.meta(data)
+        name = self.get_band_short_name(
+            self.validate_description(meta.descriptions[index])
+        )
+        full_window = Window(0, 0, meta.width, meta.height)
+
+        def load_band() -> np.ndarray:
+            band = np.empty((meta.height, meta.width), dtype=meta.profile["dtype"])
+            self.read_band(data, index, full_window, band, gdal_threads)
+            return band
+
+        resolution = int(round(meta.transform.a))
+        if self.scene_cache is None:
+            raise ValueError("Reading from the scene cache needs a scene_cache_dir.")
+        band = self.scene_cache.get(self.product_id, f"{name}_{resolution}m", load_band)
+        out[:] = band[window.toslices()]
+
+    # pylint: disable-msg=too-many-arguments
+    def read_data(
+        self,
+        datasets: List[Tuple],
+        x_mi: int,
+        y_mi: int,
+        x_ma: int,
+        y_ma: int,
+        executor: Optional[Executor] = None,
+    ) -> List[np.ndarray]:
+        """
+        This method reads the area of interest of several resolutions. The bands of
+        all raster files are decoded concurrently in the executor, and the GDAL
+        threads are split between the reads so that all the cores are busy.
+
+        Args:
+            datasets: The (raster file, validated indices, scale) of each resolution.
+            executor: The thread pool to read the bands with. Without executor
+                the bands are read one after another.
+
+        If a scene_cache_dir is set, the bands are mapped from the scene cache
+        instead of being decoded for every window.
+
+        Returns:
+            The numpy arrays of pixels' value of each resolution.
+        """
+        if executor is None and self.scene_cache is None:
+            return [
+                self.data_final(data, term, x_mi, y_mi, x_ma, y_ma, 1, scale)
+                for data, term, scale in datasets
+            ]
+        read_band = (
+            self.read_band if self.scene_cache is None else self.read_cached_band
+        )
+        n_reads = sum(len(term) for _, term, _ in datasets)
+        gdal_threads = max(
+            1,
+            READ_THREADS // max(min(self.read_threads, n_reads), 1),
+        )
+        d_finals = []
+        futures = []
+        for data, term, scale in datasets:
+            window = self.get_window(x_mi, y_mi, x_ma, y_ma, 1, scale)
+            d_final = self.allocate_bands(data, term, window)
+            for b_i, index in enumerate(term):
+                args = (data, index, window, d_final[:, :, b_i], gdal_threads)
+                if executor is None:
+                    read_band(*args)
+                else:
+                    futures.append(executor.submit(read_band, *args))
+            d_finals.append(d_final)
+        for future in futures:
+            future.result()
+        return d_finals
+
+    @staticmethod
+    def get_blocks(
+        xmin: int,
+        ymin: int,
+        xmax: int,
+        ymax: int,
+        block_size: int = BLOCK_SIZE,
+        overlap: int = BLOCK_OVERLAP,
+        min_size: int = MIN_BLOCK_SIZE,
+    ) -> List[Tuple[Tuple[int, int, int, int], Window]]:
+        """
+        This method splits the pixel region given by the output of get_max_min into
+        blocks aligned to the 60m grid. For each block it returns the pixel bounds
+        to read, which include an overlap with the neighbouring blocks, and the window
+        of the block core in the output image. The blocks to read are at least
+        min_size (a multiple of 6) wide and high, unless the region is smaller.
+
+        Examples:
+            >>> get_blocks(0, 0, 395, 197, block_size=204, overlap=12)[1]
+            ((192, 0, 395, 197), Window(col_off=204, row_off=0, width=192, height=198))
+        """
+        block_size = max(int(block_size / 6) * 6, min_size)
+
+        def split(d_min: int, d_max: int) -> List[Tuple[int, int, int, int]]:
+            # Returns the (read start, read end, core start, core end) in
+            # half-open pixel coordinates along one direction.
+            d_end = d_max + 1
+            ranges = []
+            for c_start in range(d_min, d_end, block_size):
+                c_end = min(c_start + block_size, d_end)
+                r_start = max(c_start - overlap, d_min)
+                r_end = min(c_end + overlap, d_end)
+                if r_end - r_start < min_size:
+                    r_start = max(r_end - min_size, d_min)
+                    r_end = min(r_start + min_size, d_end)
+                ranges.append((r_start, r_end, c_start, c_end))
+            return ranges
+
+        blocks = []
+        for r_y0, r_y1, c_y0, c_y1 in split(ymin, ymax):
+            for r_x0, r_x1, c_x0, c_x1 in split(xmin, xmax):
+                core = Window(
+                    col_off=c_x0 - xmin,
+                    row_off=c_y0 - ymin,
+                    width=c_x1 - c_x0,
+                    height=c_y1 - c_y0,
+                )
+                blocks.append(((r_x0, r_y0, r_x1 - 1, r_y1 - 1), core))
+        return blocks
+
     def process(self, input_fc: FeatureCollection) -> FeatureCollection:
         """
         This method takes the raster data at 10, 20, and 60 m resolutions and by applying
@@ -324,24 +634,214 @@ class Superresolution(ProcessingBlock):
         self.assert_input_params()
         output_jsonfile = self.get_final_json()
 
+        # All features are checked before the first one is processed.
+        for feature in input_fc.features:
+            path_to_input_img = feature["properties"]["up42.data_path"]
+            estimate = self.preflight(path_to_input_img)
+            LOGGER.info(f"Preflight of {path_to_input_img}: {json.dumps(estimate)}")
+
         LOGGER.info("Started process...")
+        if self.params.__dict__["in_process"]:
+            run_feature = self.run_in_process()
+        else:
+            run_feature = self.run_in_subprocess
         for feature in input_fc.features:
             LOGGER.info(f"Processing feature {feature}")
             path_to_input_img = feature["properties"]["up42.data_path"]
             path_to_output_img = Path(path_to_input_img).stem + "_superresolution.tif"
-            try:
-                subprocess.run(
-                    "python3 src/inference.py %s %s"
-                    % (path_to_input_img, path_to_output_img),
-                    check=True,
-                    shell=True,
-                )
-            except subprocess.CalledProcessError as e:
-                raise UP42Error(SupportedErrors(e.returncode)) from e
+            run_feature(path_to_input_img, path_to_output_img)
 
         self.save_output_json(output_jsonfile, self.output_dir)
         return output_jsonfile
 
+    def preflight(self, path_to_input_img: str) -> Dict[str, Any]:
+        """
+        This method checks a feature from the metadata of its raster files only,
+        before any band is read or any model is loaded, and returns the pixel
+        window, the available bands and the estimated cost of super-resolving it,
+        e.g. for choosing the machine size.
+
+        Raises:
+            UP42Error: If the region of interest is invalid or too small.
+        """
+        bands = {}  # type: Dict[str, List[str]]
+        dims = None
+        with DATASET_CACHE:
+            data_list, image_level = self.get_data(path_to_input_img)
+            for dsdesc in data_list:
+                for resolution in ["10m", "20m", "60m"]:
+                    if resolution in dsdesc:
+                        bands[resolution] = self.validate(dsdesc)[0]
+                        if resolution == "10m":
+                            dims = self.get_region(dsdesc)[:4]
+        if dims is None:
+            raise UP42Error(
+                SupportedErrors.WRONG_INPUT_ERROR,
+                f"No 10m bands found in {path_to_input_img}.",
+            )
+        self.check_size(
+            dims=dims,
+            min_size=max(
+                self.params.__dict__["patch_size_20m"],
+                self.params.__dict__["patch_size_60m"],
+            ),
+        )
+        output_bands = self.params.__dict__["output_bands"] or SR_BANDS
+        sr_bands = {
+            resolution: [b for b in bands.get(resolution, []) if b in output_bands]
+            for resolution in ["20m", "60m"]
+        }
+        if not (bands.get("10m") and bands.get("20m")):
+            sr_bands = {"20m": [], "60m": []}
+        estimate = {
+            "image_level": image_level,
+            "window": list(dims),
+            "bands": bands,
+            "sr_bands": sr_bands["20m"] + sr_bands["60m"],
+        }
+        estimate.update(self.estimate_cost(dims, bands, sr_bands))
+        return estimate
+
+    def get_batch_budget(self, n_models: int, fused: bool) -> Optional[int]:
+        """
+        Returns the memory budget that the batch size of each model is derived from,
+        shared between the n_models models in the fused mode. Without a
+        memory_budget_gb or auto_tune the models predict in batches of BATCH_SIZE,
+        and None is returned.
+        """
+        if not (
+            self.params.__dict__["memory_budget_gb"]
+            or self.params.__dict__["auto_tune"]
+        ):
+            return None
+        return self.memory_budget // (n_models if fused else 1)
+
+    # pylint: disable-msg=too-many-locals
+    def estimate_cost(
+        self,
+        dims: Tuple[int, int, int, int],
+        bands: Dict[str, List[str]],
+        sr_bands: Dict[str, List[str]],
+    ) -> Dict[str, Any]:
+        """
+        This method estimates the cost of super-resolving the region given by dims:
+        the number of output pixels, the number of patches of each model and the
+        peak memory in bytes. The peak is reached on the largest block that is held
+        in memory at once, the whole region unless streaming is set, with its
+        inputs, the padded model inputs, the predicted bands and the batches.
+        """
+        xmin, ymin, xmax, ymax = dims
+        size = (ymax - ymin + 1, xmax - xmin + 1)
+        resolutions = [r for r in ["20m", "60m"] if sr_bands[r]]
+        patch_sizes = {
+            r: (
+                self.params.__dict__[f"patch_size_{r}"],
+                self.params.__dict__[f"border_{r}"],
+            )
+            for r in resolutions
+        }
+        patches = {r: count_patches(size, r, *patch_sizes[r]) for r in resolutions}
+        if not resolutions:
+            return {"pixels": size[0] * size[1], "patches": {}, "memory_bytes": 0}
+
+        block = size
+        n_blocks = 1
+        if self.params.__dict__["streaming"]:
+            min_size = max(p for p, _ in patch_sizes.values())
+            blocks = self.get_blocks(
+                *dims,
+                block_size=self.params.__dict__["block_size"],
+                min_size=-(-max(min_size, MIN_BLOCK_SIZE) // 6) * 6,
+            )
+            block = max(
+                ((y_1 - y_0 + 1, x_1 - x_0 + 1) for (x_0, y_0, x_1, y_1), _ in blocks),
+                key=lambda shape: shape[0] * shape[1],
+            )
+            n_blocks = len(blocks)
+        n_10m, n_20m = len(bands["10m"]), len(bands["20m"])
+        n_60m = len(bands.get("60m", [])) if "60m" in resolutions else 0
+        channels = {"20m": n_10m + n_20m, "60m": n_10m + n_20m + n_60m}
+        factor = RESOLUTION_FACTORS[resolutions[-1]]
+        border = max(b for _, b in patch_sizes.values())
+        border = -(-border // factor) * factor
+        n_out = len(sr_bands["20m"]) + len(sr_bands["60m"])
+        if self.params.__dict__["copy_original_bands"]:
+            n_out += n_10m
+        pixels = block[0] * block[1]
+        # The uint16 inputs, the padded and scaled model inputs, and the uint16
+        # predictions of each model and their concatenation.
+        memory = pixels * (n_10m + n_20m / 4 + n_60m / 36) * 2
+        memory += (
+            (block[0] + 2 * border)
+            * (block[1] + 2 * border)
+            * channels[resolutions[-1]]
+            * (2 if self.params.__dict__["integer_io"] else 4)
+        )
+        memory += 2 * pixels * n_out * 2
+        fused = self.params.__dict__["fused_models"]
+        budget = self.get_batch_budget(len(resolutions), fused)
+        batches = []
+        for resolution in resolutions:
+            patch_size = patch_sizes[resolution][0]
+            batch_size = BATCH_SIZE
+            if budget is not None:
+                batch_size = get_batch_size(patch_size, channels[resolution], budget)
+            batch_size = min(
+                batch_size, count_patches(block, resolution, *patch_sizes[resolution])
+            )
+            batches.append(
+                estimate_batch_memory(patch_size, channels[resolution], batch_size)
+            )
+        memory += sum(batches) if fused else max(batches)
+        return {
+            "pixels": size[0] * size[1],
+            "patches": patches,
+            "blocks": n_blocks,
+            "memory_bytes": int(memory),
+        }
+
+    @staticmethod
+    def run_in_subprocess(path_to_input_img: str, path_to_output_img: str):
+        """
+        Runs the inference for one feature in a fresh python process. All the memory
+        used by TensorFlow and the models is released once the process exits.
+        """
+        try:
+            subprocess.run(
+                "python3 src/inference.py %s %s"
+                % (path_to_input_img, path_to_output_img),
+                check=True,
+                shell=True,
+            )
+        except subprocess.CalledProcessError as e:
+            raise UP42Error(SupportedErrors(e.returncode)) from e
+
+    def run_in_process(self) -> Callable[[str, str], None]:
+        """
+        Returns a function running the inference for one feature in the current
+        process. TensorFlow, the distribution strategy and the loaded models stay
+        warm across features, and the exit codes of SuperresolutionProcess.start
+        are mapped to the same UP42Error codes as in run_in_subprocess.
+        """
+        # Imported here since inference imports this module.
+        # pylint: disable=import-outside-toplevel
+        from inference import SuperresolutionProcess
+
+        processor = SuperresolutionProcess(
+            self.params, self.output_dir, self.input_dir, self.data_folder
+        )
+
+        def run_feature(path_to_input_img: str, path_to_output_img: str):
+            try:
+                processor.start(path_to_input_img, path_to_output_img)
+            except SystemExit as e:
+                if e.code:
+                    raise UP42Error(SupportedErrors(e.code)) from e
+            finally:
+                LOGGER.info("This is for releasing memory: %s", gc.collect())
+
+        return run_feature
+
     @staticmethod
     def save_output_json(output_jsonfile, output_dir):
         with open(output_dir + "data.json", "w") as f_p:
@@ -349,21 +849,20 @@ class Superresolution(ProcessingBlock):
 
     # pylint: disable-msg=too-many-arguments
     @staticmethod
-    def update(data, size_10m: Tuple, model_output: np.ndarray, xmi: int, ymi: int):
+    def update(data, size_10m: Tuple, out_dims: int, xmi: int, ymi: int):
         """
         This method creates the proper georeferencing for the output image.
 
         Args:
 
             data: The raster file for 10m resolution.
+            size_10m: The (height, width) of the output image.
+            out_dims: The number of bands of the output image.
         """
-        # Here based on the params.json file, the output image dimension will be calculated.
-        out_dims = model_output.shape[2]
-
-        with rasterio.open(data) as d_s:
-            p_r = d_s.profile
+        p_r = DATASET_CACHE.meta(data).profile.copy()
         new_transform = p_r["transform"] * A.translation(xmi, ymi)
         p_r.update(dtype=rasterio.uint16)
+        p_r.update(nodata=NODATA)
         p_r.update(driver="GTiff")
         p_r.update(width=size_10m[1])
         p_r.update(height=size_10m[0])
@@ -372,6 +871,74 @@ class Superresolution(ProcessingBlock):
         return p_r
 
     def assert_input_params(self):
+        if str(self.params.__dict__["compression"]).upper() not in COMPRESSIONS:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"compression must be one of {', '.join(COMPRESSIONS)}.",
+            )
+        if self.params.__dict__["output_format"] not in OUTPUT_FORMATS:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"output_format must be one of {', '.join(OUTPUT_FORMATS)}.",
+            )
+        if self.params.__dict__["runtime"] not in RUNTIMES:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"runtime must be one of {', '.join(RUNTIMES)}.",
+            )
+        missing = missing_packages(self.params.__dict__["runtime"])
+        if missing:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"The {self.params.__dict__['runtime']} runtime needs "
+                f"{', '.join(missing)} installed.",
+            )
+        if self.params.__dict__["model_precision"] not in PRECISIONS:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"model_precision must be one of {', '.join(PRECISIONS)}.",
+            )
+        if (
+            self.params.__dict__["model_precision"] != "float32"
+            and self.params.__dict__["runtime"] != "tflite"
+        ):
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                "A model_precision other than float32 needs the tflite runtime.",
+            )
+        if (
+            self.params.__dict__["integer_io"]
+            and self.params.__dict__["model_precision"] == "int8"
+        ):
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                "The int8 model_precision does not support integer_io.",
+            )
+        output_bands = self.params.__dict__["output_bands"]
+        if output_bands is not None and (
+            not isinstance(output_bands, list)
+            or not output_bands
+            or not set(output_bands).issubset(SR_BANDS)
+        ):
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                f"output_bands must be null or a list of bands from {', '.join(SR_BANDS)}.",
+            )
+        prefetch_depth = self.params.__dict__["prefetch_depth"]
+        if not isinstance(prefetch_depth, int) or prefetch_depth < 0:
+            raise UP42Error(
+                SupportedErrors.INPUT_PARAMETERS_ERROR,
+                "prefetch_depth must be a non-negative integer.",
+            )
+        for resolution in PATCH_SIZES:
+            try:
+                check_patch_size(
+                    resolution,
+                    self.params.__dict__[f"patch_size_{resolution}"],
+                    self.params.__dict__[f"border_{resolution}"],
+                )
+            except ValueError as e:
+                raise UP42Error(SupportedErrors.INPUT_PARAMETERS_ERROR, str(e)) from e
         if not self.params.__dict__["clip_to_aoi"]:
             if self.params.bbox or self.params.contains or self.params.intersects:
                 raise UP42Error(
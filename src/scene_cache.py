@@ -0,0 +1,85 @@
+"""
+This module keeps decoded Sentinel-2 bands on the local disk, so that several runs
+on the same product map the bands from .npy files instead of decoding the
+JPEG2000 files again.
+"""
+import os
+import threading
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+from blockutils.logging import get_logger
+
+LOGGER = get_logger(__name__)
+
+
+class SceneCache:
+    """
+    Stores each decoded band as a memory-mappable .npy file keyed by product ID
+    and band name. When the cache grows beyond max_bytes, the least recently used
+    files are removed.
+
+    Examples:
+        >>> cache = SceneCache("/tmp/scene_cache", 50 * 1024 ** 3)
+        >>> band = cache.get("S2A_MSIL1C_20200601T101031", "B5_20m", read_b5)
+        >>> band[100:200, 100:200]
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, product_id: str, band: str) -> Path:
+        return self.cache_dir / product_id / f"{band}.npy"
+
+    def get(
+        self, product_id: str, band: str, loader: Callable[[], np.ndarray]
+    ) -> np.ndarray:
+        """
+        Returns the band memory-mapped from the cache. On a miss the band is
+        decoded with loader and stored first.
+        """
+        path = self.path(product_id, band)
+        if path.exists():
+            with self.lock:
+                self.hits += 1
+            # Mark the file as recently used for the eviction.
+            os.utime(path)
+        else:
+            with self.lock:
+                self.misses += 1
+            LOGGER.info(f"Caching band {band} of {product_id}")
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(
+                f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            with open(tmp_path, "wb") as f_p:
+                np.save(f_p, loader())
+            os.replace(tmp_path, path)
+            self.evict(keep=path)
+        return np.load(path, mmap_mode="r")
+
+    def files(self) -> List[Path]:
+        """Returns the cached files, the least recently used first."""
+        return sorted(self.cache_dir.rglob("*.npy"), key=lambda p: p.stat().st_mtime)
+
+    def size(self) -> int:
+        return sum(p.stat().st_size for p in self.files())
+
+    def evict(self, keep: Path):
+        with self.lock:
+            files = self.files()
+            total = sum(p.stat().st_size for p in files)
+            for path in files:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                total -= path.stat().st_size
+                path.unlink()
+                LOGGER.info(f"Evicted {path} from the scene cache.")
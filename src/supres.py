@@ -1,13 +1,30 @@
 from __future__ import division
 
 import gc
-import tensorflow as tf
+import json
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
 import numpy as np
 from tqdm import tqdm
-from tensorflow import keras
 from blockutils.logging import get_logger
 
-from patches import get_test_patches, get_test_patches60, recompose_images
+from backends import (
+    Backend,
+    KerasBackend,
+    accuracy_report,
+    get_model_path,
+    integer_io_model,
+    load_backend,
+)
+from patches import Mosaic, TilePlan, PATCH_SIZES, check_patch_size
 
 LOGGER = get_logger(__name__)
 # This code is adapted from this repository
@@ -22,70 +39,467 @@ L1C_MDL_PATH_60M_DSEN2 = MDL_PATH + "l1c_dsen2_60m_s2_038_lr_1e-04.hdf5"
 L2A_MDL_PATH_20M_DSEN2 = MDL_PATH + "l2a_dsen2_20m_s2_038_lr_1e-04.hdf5"
 L2A_MDL_PATH_60M_DSEN2 = MDL_PATH + "l2a_dsen2_60m_s2_038_lr_1e-04.hdf5"
 
-STRATEGY = tf.distribute.MirroredStrategy()
+# Number of batches prepared ahead of the prediction.
+PREFETCH_DEPTH = 2
+BATCH_SIZE = 128
+MAX_BATCH_SIZE = 1024
+# Float32 feature maps per pixel held during a prediction, two DSen2 layers of 128.
+FEATURE_MAPS = 2 * 128
+# Candidate patch sizes of the auto-tune mode and patches per benchmark.
+TUNE_CANDIDATES = {"20m": [96, 128, 192, 256, 384], "60m": [192, 264, 384]}
+TUNE_PATCHES = 8
+# Number of scene patches the int8 models are calibrated on.
+CALIBRATION_PATCHES = 32
+
+MODEL_PATHS = {
+    ("20m", "MSIL1C"): L1C_MDL_PATH_20M_DSEN2,
+    ("60m", "MSIL1C"): L1C_MDL_PATH_60M_DSEN2,
+    ("20m", "MSIL2A"): L2A_MDL_PATH_20M_DSEN2,
+    ("60m", "MSIL2A"): L2A_MDL_PATH_60M_DSEN2,
+}
+
+
+# TensorFlow is only imported once a model is loaded, so that the parameters and
+# the area of interest can be checked without its startup and device discovery.
+@lru_cache(maxsize=None)
+def get_strategy():
+    """Returns the distribution strategy of the Keras models over all GPUs,
+    created on the first call."""
+    # pylint: disable=import-outside-toplevel
+    import tensorflow as tf
+
+    return tf.distribute.MirroredStrategy()
+
+
+def allocation_errors() -> Tuple[Type[BaseException], ...]:
+    """Returns the errors of a failed allocation during a prediction, including the
+    TensorFlow one if TensorFlow is loaded."""
+    tf = sys.modules.get("tensorflow")
+    if tf is None:
+        return (MemoryError,)
+    return (MemoryError, tf.errors.ResourceExhaustedError)
+
+
+def get_model_key(resolution: str, image_level: str) -> Tuple[str, str]:
+    """Returns the registry key of the DSen2 model for a resolution ("20m" or "60m")
+    and an image level. Every level other than MSIL1C uses the L2A weights."""
+    if resolution not in ("20m", "60m"):
+        raise ValueError(f"No DSen2 model for resolution {resolution}.")
+    return resolution, "MSIL1C" if image_level == "MSIL1C" else "MSIL2A"
+
+
+def load_model(
+    model_filename: str,
+    runtime: str = "keras",
+    precision: str = "float32",
+    calibration: Optional[List[np.ndarray]] = None,
+    integer_io: bool = False,
+) -> Backend:
+    """
+    Loads the DSen2 model of the HDF5 file model_filename for runtime, one of
+    backends.RUNTIMES. The other runtimes load a model converted from the file.
+    A quantized TFLite model of precision is calibrated on the calibration input
+    batches of the scene, and its accuracy against the float32 model on these
+    batches is logged and saved next to it. With integer_io, the model takes the
+    raw uint16 data and returns uint16 predictions, scaled by SCALE in the graph.
+    """
+    io_scale = SCALE if integer_io else None
+    if precision != "float32":
+        model = load_backend(
+            model_filename,
+            runtime,
+            precision=precision,
+            calibration=calibration,
+            io_scale=io_scale,
+        )
+        if calibration is not None:
+            report = accuracy_report(
+                load_backend(model_filename, runtime, io_scale=io_scale).predict(
+                    calibration
+                ),
+                model.predict(calibration),
+                scale=1 if integer_io else SCALE,
+            )
+            LOGGER.info(f"Accuracy of the {precision} model vs. float32: {report}")
+            report_path = Path(
+                get_model_path(model_filename, runtime, precision, io_scale)
+            ).with_suffix(".json")
+            report_path.write_text(json.dumps(report, indent=2))
+        return model
+    if runtime != "keras":
+        model = load_backend(model_filename, runtime, io_scale=io_scale)
+        LOGGER.info(f"{runtime} model loaded for: {model_filename}")
+        return model
+    # pylint: disable=import-outside-toplevel
+    from tensorflow import keras
+
+    with get_strategy().scope():
+        model = keras.models.load_model(model_filename)
+        if integer_io:
+            model = integer_io_model(model, SCALE)
+    LOGGER.info(f"Symbolic Model Created from file: {model_filename}")
+    return KerasBackend(model)
+
 
+class ModelRegistry:
+    """
+    Keeps the loaded DSen2 models in memory, keyed by (resolution, image level),
+    so that each weight file is loaded at most once per process. When more than
+    max_models are loaded, the least recently used model is evicted. The batch
+    size a model fell back to after an allocation failure is kept per model and
+    patch size, so that the following blocks start with it.
+    """
 
-def dsen2_20(d10, d20, image_level):
+    def __init__(self, max_models: int = 4, loader: Callable = load_model):
+        self.max_models = max_models
+        self.loader = loader
+        self.models = OrderedDict()  # type: OrderedDict
+        self.loads = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.batch_limits = {}  # type: Dict[Tuple, int]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(
+        resolution: str,
+        image_level: str,
+        runtime: str = "keras",
+        precision: str = "float32",
+        integer_io: bool = False,
+    ) -> Tuple:
+        return get_model_key(resolution, image_level) + (runtime, precision, integer_io)
+
+    # pylint: disable=too-many-arguments
+    def get(
+        self,
+        resolution: str,
+        image_level: str,
+        runtime: str = "keras",
+        precision: str = "float32",
+        calibration: Optional[Callable[[], List[np.ndarray]]] = None,
+        integer_io: bool = False,
+    ):
+        """Returns the model, loaded on the first request. calibration returns the
+        calibration batches of quantized models and is only called to load one."""
+        key = self.key(resolution, image_level, runtime, precision, integer_io)
+        with self.lock:
+            if key in self.models:
+                self.hits += 1
+                self.models.move_to_end(key)
+                return self.models[key]
+            self.misses += 1
+            model = self.loader(
+                MODEL_PATHS[key[:2]],
+                runtime,
+                precision,
+                calibration() if calibration and precision != "float32" else None,
+                integer_io,
+            )
+            self.loads += 1
+            self.models[key] = model
+            while len(self.models) > self.max_models:
+                evicted, _ = self.models.popitem(last=False)
+                self.evictions += 1
+                LOGGER.info(f"Evicted model {evicted} from the registry.")
+        return model
+
+    def batch_size(self, key: Tuple, patch_size: int, batch_size: int) -> int:
+        """Returns batch_size, capped by the batch size that the model of key fell
+        back to with patches of patch_size."""
+        return min(batch_size, self.batch_limits.get(key + (patch_size,), batch_size))
+
+    def limit_batch_size(self, key: Tuple, patch_size: int, batch_size: int):
+        """Keeps the batch size that the model of key fell back to with patches of
+        patch_size after an allocation failure."""
+        with self.lock:
+            self.batch_limits[key + (patch_size,)] = self.batch_size(
+                key, patch_size, batch_size
+            )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "loaded": len(self.models),
+            "loads": self.loads,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+        LOGGER.info("This is for releasing memory: %s", gc.collect())
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+# pylint: disable=too-many-arguments
+def dsen2_20(
+    d10,
+    d20,
+    image_level,
+    queue_depth=PREFETCH_DEPTH,
+    plan=None,
+    patch_size=PATCH_SIZES["20m"][0],
+    border=PATCH_SIZES["20m"][1],
+    memory_budget=None,
+    runtime="keras",
+    precision="float32",
+    integer_io=False,
+):
     # Input to the funcion must be of shape:
     #     d10: [x,y,4]      (B2, B3, B4, B8)
     #     d20: [x/2,y/4,6]  (B5, B6, B7, B8a, B11, B12)
     #     deep: specifies whether to use VDSen2 (True), or DSen2 (False)
+    # A TilePlan shared with dsen2_60 can be passed instead of d10 and d20.
 
-    border = 8
-    p10, p20 = get_test_patches(d10, d20, patch_size=128, border=border)
-    p10 /= SCALE
-    p20 /= SCALE
-    test = [p10, p20]
-    if image_level == "MSIL1C":
-        model_filename = L1C_MDL_PATH_20M_DSEN2
-    else:
-        model_filename = L2A_MDL_PATH_20M_DSEN2
+    if plan is None:
+        plan = _tile_plan(d10, d20, None, border, integer_io)
+    test = plan.grids(patch_size, border)
+    return _run_model(
+        "20m",
+        test,
+        plan,
+        image_level,
+        border,
+        queue_depth,
+        memory_budget,
+        runtime,
+        precision,
+        integer_io,
+    )
 
-    prediction = _predict(test, model_filename)
-    del test, p10, p20
-    images = recompose_images(prediction, border=border, size=d10.shape)
-    images *= SCALE
-    return images
 
-
-def dsen2_60(d10, d20, d60, image_level):
+# pylint: disable=too-many-arguments
+def dsen2_60(
+    d10,
+    d20,
+    d60,
+    image_level,
+    queue_depth=PREFETCH_DEPTH,
+    plan=None,
+    patch_size=PATCH_SIZES["60m"][0],
+    border=PATCH_SIZES["60m"][1],
+    memory_budget=None,
+    runtime="keras",
+    precision="float32",
+    integer_io=False,
+):
     # Input to the funcion must be of shape:
     #     d10: [x,y,4]      (B2, B3, B4, B8)
     #     d20: [x/2,y/4,6]  (B5, B6, B7, B8a, B11, B12)
     #     d60: [x/6,y/6,2]  (B1, B9) -- NOT B10
     #     deep: specifies whether to use VDSen2 (True), or DSen2 (False)
+    # A TilePlan shared with dsen2_20 can be passed instead of d10, d20 and d60.
+
+    if plan is None:
+        plan = _tile_plan(d10, d20, d60, border, integer_io)
+    test = plan.grids(patch_size, border, with_60m=True)
+    return _run_model(
+        "60m",
+        test,
+        plan,
+        image_level,
+        border,
+        queue_depth,
+        memory_budget,
+        runtime,
+        precision,
+        integer_io,
+    )
+
 
-    border = 12
-    p10, p20, p60 = get_test_patches60(d10, d20, d60, patch_size=192, border=border)
-    p10 /= SCALE
-    p20 /= SCALE
-    p60 /= SCALE
+def _tile_plan(d10, d20, d60, border, integer_io=False) -> TilePlan:
+    """Returns the TilePlan of the inputs of the models, scaled to float32 or, for
+    the models with integer_io, kept as uint16."""
+    if integer_io:
+        return TilePlan(d10, d20, d60, border=border, nodata=0, keep_dtype=True)
+    return TilePlan(d10, d20, d60, border=border, scale=SCALE, nodata=0)
 
-    test = [p10, p20, p60]
-    if image_level == "MSIL1C":
-        model_filename = L1C_MDL_PATH_60M_DSEN2
-    else:
-        model_filename = L2A_MDL_PATH_60M_DSEN2
-    prediction = _predict(test, model_filename)
-    del test, p10, p20, p60
-    images = recompose_images(prediction, border=border, size=d10.shape)
-    images *= SCALE
-    return images
+
+# pylint: disable=too-many-arguments
+def _run_model(
+    resolution,
+    test,
+    plan,
+    image_level,
+    border,
+    queue_depth,
+    memory_budget,
+    runtime="keras",
+    precision="float32",
+    integer_io=False,
+) -> np.ndarray:
+    """Predicts the valid patches of test with the model of resolution into a
+    preallocated uint16 image with the bands of the last input. The predictions
+    are at least 1, as 0 is the nodata value of the output. The models with
+    integer_io take the uint16 patches of a plan without scale as they are."""
+    if integer_io and plan.scale is not None:
+        raise ValueError("The models with integer_io need a plan without scale.")
+    patch_size = test[0].shape[-1]
+    test = _skip_nodata(test, plan, patch_size, border)
+    mosaic = Mosaic(
+        plan.shape,
+        border,
+        test[0].origins_i,
+        test[0].origins_j,
+        scale=1 if integer_io else SCALE,
+        bands=test[-1].shape[1],
+        min_value=1,
+    )
+    prepared = plan.scale is not None or integer_io
+    if len(test[0]):
+        batch_size = BATCH_SIZE
+        if memory_budget is not None:
+            batch_size = get_batch_size(
+                patch_size, sum(grid.shape[1] for grid in test), memory_budget
+            )
+        key = MODEL_REGISTRY.key(
+            resolution, image_level, runtime, precision, integer_io
+        )
+        batch_size = MODEL_REGISTRY.batch_size(key, patch_size, batch_size)
+        predicted_batch_size = _predict(
+            test,
+            MODEL_REGISTRY.get(
+                resolution,
+                image_level,
+                runtime,
+                precision,
+                lambda: _calibration_patches(test, prepared),
+                integer_io,
+            ),
+            mosaic,
+            queue_depth,
+            prepared,
+            batch_size,
+        )
+        if predicted_batch_size < batch_size:
+            MODEL_REGISTRY.limit_batch_size(key, patch_size, predicted_batch_size)
+    return mosaic.image
+
+
+def _calibration_patches(test, normalized: bool) -> List[np.ndarray]:
+    """Returns up to CALIBRATION_PATCHES patches spread over the grids of test as
+    input batches of the model."""
+    indices = np.linspace(
+        0, len(test[0]) - 1, min(CALIBRATION_PATCHES, len(test[0]))
+    ).astype(int)
+    prepare = np.asarray if normalized else normalize
+    return [prepare(grid[indices]) for grid in test]
+
+
+def _skip_nodata(test, plan: TilePlan, patch_size: int, border: int):
+    """Leaves the patches without any valid 10m pixel out of the patch grids."""
+    keep = plan.valid_patches(test[0], patch_size, border)
+    if keep is None or len(keep) == len(test[0]):
+        return test
+    LOGGER.info(f"Skipping {len(test[0]) - len(keep)} of {len(test[0])} nodata patches")
+    return [grid.select(keep) for grid in test]
+
+
+def get_batch_size(patch_size: int, channels: int, memory_budget: int) -> int:
+    """Returns the largest batch size, up to MAX_BATCH_SIZE, whose estimated memory
+    fits memory_budget, and at least 1."""
+    per_patch = estimate_batch_memory(patch_size, channels, 1)
+    return int(min(max(memory_budget // per_patch, 1), MAX_BATCH_SIZE))
+
+
+def estimate_batch_memory(patch_size: int, channels: int, batch_size: int) -> int:
+    """Rough number of bytes needed to predict a batch of patches of patch_size
+    with channels input bands, dominated by the float32 feature maps."""
+    return batch_size * patch_size ** 2 * (channels + FEATURE_MAPS) * 4
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def tune_patch_size(
+    plan: TilePlan,
+    resolution: str,
+    image_level: str,
+    border: int,
+    memory_budget: int,
+    candidates: Optional[List[int]] = None,
+    batch_size: int = BATCH_SIZE,
+    runtime: str = "keras",
+    precision: str = "float32",
+    integer_io: bool = False,
+) -> int:
+    """
+    Benchmarks the model of resolution on a few patches of the plan for each
+    candidate patch size and returns the size with the highest number of output
+    pixels per second. Candidates that do not fit the image or whose batches
+    need more than memory_budget bytes are skipped.
+    """
+    with_60m = resolution == "60m"
+    prepared = plan.scale is not None or integer_io
+    model = MODEL_REGISTRY.get(
+        resolution,
+        image_level,
+        runtime,
+        precision,
+        lambda: _calibration_patches(
+            plan.grids(PATCH_SIZES[resolution][0], border, with_60m), prepared
+        ),
+        integer_io,
+    )
+    channels = sum(buffer.shape[2] for buffer in plan.buffers[: 3 if with_60m else 2])
+    best_size, best_throughput = PATCH_SIZES[resolution][0], 0.0
+    for patch_size in candidates or TUNE_CANDIDATES[resolution]:
+        try:
+            check_patch_size(resolution, patch_size, border)
+        except ValueError:
+            continue
+        if (
+            patch_size > min(plan.shape[:2])
+            or estimate_batch_memory(patch_size, channels, batch_size) > memory_budget
+        ):
+            continue
+        grids = plan.grids(patch_size, border, with_60m)
+        n_patches = min(TUNE_PATCHES, len(grids[0]))
+        prepare = np.asarray if prepared else normalize
+        sample = [prepare(grid[:n_patches]) for grid in grids]
+        model.predict(sample)  # warm-up, e.g. for building the graph
+        start = time.perf_counter()
+        model.predict(sample)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        throughput = n_patches * (patch_size - 2 * border) ** 2 / elapsed
+        LOGGER.info(
+            f"Patch size {patch_size} of the {resolution} model: "
+            f"{throughput:.0f} pixels per second"
+        )
+        if throughput > best_throughput:
+            best_size, best_throughput = patch_size, throughput
+    LOGGER.info(f"Selected patch size {best_size} for the {resolution} model")
+    return best_size
 
 
 class BatchGenerator:
-    def __init__(self, dataset_list, batch_size=128):
+    """
+    Splits the patch arrays (or PatchGrids) into batches. The patches of a batch
+    are only materialized when the batch is requested.
+    """
+
+    def __init__(self, dataset_list, batch_size=BATCH_SIZE):
         self.batch_size = batch_size
         self.n_batches = dataset_list[0].shape[0] // batch_size
         if not self.n_batches:
             self.n_batches = 1
         LOGGER.info(f"Dividing into {self.n_batches} batches.")
-        self.data_list_splitted = [
-            np.array_split(d, self.n_batches, axis=0) for d in dataset_list
+        self.dataset_list = dataset_list
+        self.batch_slices = [
+            slice(indices[0], indices[-1] + 1)
+            for indices in np.array_split(
+                np.arange(dataset_list[0].shape[0]), self.n_batches
+            )
         ]
-        self.len = len(self.data_list_splitted[0])
-        LOGGER.info(f"Each batch has {self.data_list_splitted[0][0].shape[0]} patches.")
-        self.iter = iter(zip(*self.data_list_splitted))
+        self.len = len(self.batch_slices)
+        LOGGER.info(f"Each batch has {self.batch_slices[0].stop} patches.")
+        self.iter = (
+            tuple(d[batch_slice] for d in self.dataset_list)
+            for batch_slice in self.batch_slices
+        )
 
     def __len__(self):
         return self.len
@@ -97,20 +511,132 @@ class BatchGenerator:
         return self
 
 
-def _predict(test, model_filename):
-    with STRATEGY.scope():
-        model = keras.models.load_model(model_filename)
-    LOGGER.info("Symbolic Model Created.")
-    LOGGER.info(f"Predicting using file: {model_filename}")
-    first = True
-    for a_slice in tqdm(BatchGenerator(test)):
-        if first:
-            first = False
-            prediction = model.predict(a_slice)
-        else:
-            prediction = np.append(prediction, model.predict(a_slice), axis=0)
+def normalize(patches: np.ndarray) -> np.ndarray:
+    """Scales a batch of raw patches to the input range of the models."""
+    return patches.astype(np.float32) / SCALE
+
+
+class _ProducerError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(iterable: Iterable, depth: int = PREFETCH_DEPTH) -> Iterator:
+    """
+    Iterates over iterable in a producer thread, which keeps up to depth items
+    ready while the caller works on the current one. Exceptions of the producer
+    are raised in the caller. With a depth of 0 nothing is prefetched.
+    """
+    if depth < 1:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize=depth)  # type: queue.Queue
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:  # pylint: disable=broad-except
+            put(_ProducerError(e))
+        put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, _ProducerError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+class AdaptivePredictor:
+    """
+    Predicts batches with model in chunks of at most batch_size patches, passed to
+    model.predict as one batch. When an allocation fails, the batch size is
+    halved for the failed and all following chunks, so that the job goes on with
+    smaller batches instead of failing.
+    """
+
+    def __init__(self, model, batch_size: int = BATCH_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+        self.retries = 0
+
+    def predict(self, inputs) -> Iterator[np.ndarray]:
+        """Yields the predictions of the consecutive chunks of inputs."""
+        start, n_patches = 0, len(inputs[0])
+        errors = allocation_errors()
+        while start < n_patches:
+            stop = min(start + self.batch_size, n_patches)
+            try:
+                predictions = self.model.predict(
+                    [d[start:stop] for d in inputs], batch_size=stop - start
+                )
+            except errors:
+                if self.batch_size == 1:
+                    raise
+                self.batch_size = max(self.batch_size // 2, 1)
+                self.retries += 1
+                gc.collect()
+                LOGGER.warning(
+                    f"Allocation failed, retrying with batches of {self.batch_size}"
+                )
+                continue
+            yield predictions
+            start = stop
+
+
+# pylint: disable=too-many-arguments
+def _predict(
+    test,
+    model,
+    mosaic,
+    queue_depth=PREFETCH_DEPTH,
+    normalized=False,
+    batch_size=BATCH_SIZE,
+) -> int:
+    """
+    Predicts the patches batch by batch and writes each batch into the mosaic as
+    soon as it is predicted. A producer thread materializes and normalizes the
+    next queue_depth batches while the model predicts the current one, and a
+    consumer thread writes the predictions into the mosaic. With normalized, the
+    patches are passed as they are (e.g. cut from a TilePlan with scale=SCALE, or
+    uint16 patches for a model with integer inputs). Returns the batch size the
+    predictions ended with, smaller than batch_size after an allocation failure.
+    """
+    LOGGER.info(f"Predicting using model: {model.name}")
+    generator = BatchGenerator(test, batch_size)
+    prepare = np.asarray if normalized else normalize
+    batches = ([prepare(d) for d in a_slice] for a_slice in generator)
+    predictor = AdaptivePredictor(model, batch_size)
+    pending = deque()  # type: deque
+    with ThreadPoolExecutor(1) as consumer:
+        for a_slice in tqdm(prefetch(batches, queue_depth), total=len(generator)):
+            for predictions in predictor.predict(a_slice):
+                pending.append(consumer.submit(mosaic.add, predictions))
+                while len(pending) > max(queue_depth, 1):
+                    pending.popleft().result()
+        for future in pending:
+            future.result()
 
     LOGGER.info("Predicted...")
-    del model
-    LOGGER.info("This is for releasing memory: %s", gc.collect())
-    return prediction
+    LOGGER.info(f"Model registry: {MODEL_REGISTRY.stats()}")
+    return predictor.batch_size
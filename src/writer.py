@@ -0,0 +1,171 @@
+"""
+This module writes the super-resolved bands into tiled and compressed GeoTIFFs.
+"""
+
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.io import DatasetWriter
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window
+from blockutils.logging import get_logger
+
+LOGGER = get_logger(__name__)
+
+COMPRESSIONS = ["DEFLATE", "ZSTD", "LZW", "NONE"]
+OUTPUT_FORMATS = ["GTiff", "COG"]
+TILE_SIZE = 512
+
+
+def get_overview_factors(
+    width: int, height: int, tile_size: int = TILE_SIZE
+) -> List[int]:
+    """
+    Returns the decimation factors of the overviews, halving the image until it
+    fits into a single tile.
+
+    Examples:
+        >>> get_overview_factors(10980, 10980)
+        [2, 4, 8, 16, 32]
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > tile_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def get_output_profile(
+    profile: Dict, compress: str = "DEFLATE", tile_size: int = TILE_SIZE
+) -> Dict:
+    """
+    Returns a copy of the given profile for a tiled GeoTIFF, compressed with a
+    horizontal differencing predictor and multi-threaded compression.
+
+    Args:
+        profile: The georeferencing for the output image.
+        compress: One of COMPRESSIONS.
+        tile_size: The size of the internal tiles, a multiple of 16.
+    """
+    compress = compress.upper()
+    if compress not in COMPRESSIONS:
+        raise ValueError(f"Compression {compress} is not one of {COMPRESSIONS}.")
+    if tile_size % 16:
+        raise ValueError("The tile size must be a multiple of 16.")
+
+    out_profile = profile.copy()
+    out_profile.update(
+        driver="GTiff",
+        tiled=True,
+        blockxsize=tile_size,
+        blockysize=tile_size,
+        interleave="pixel",
+        BIGTIFF="IF_SAFER",
+    )
+    if compress == "NONE":
+        out_profile.pop("compress", None)
+        out_profile.pop("predictor", None)
+    else:
+        out_profile.update(compress=compress, predictor=2, num_threads="ALL_CPUS")
+    return out_profile
+
+
+class ResultWriter:
+    """
+    Writes channel-last arrays into the output image as they are produced.
+
+    With output_format "COG" the windows go into a temporary tiled GeoTIFF next
+    to the output image. Its internal overviews are built when the writer is
+    closed, and it is then laid out as a Cloud-Optimized GeoTIFF reusing those
+    overviews.
+
+    Examples:
+        >>> with ResultWriter("out.tif", profile, ["SR B5 (705 nm)"]) as writer:
+        >>>     writer.write(block, Window(0, 0, 512, 512))
+    """
+
+    def __init__(
+        self,
+        image_name: str,
+        output_profile: Dict,
+        band_descriptions: List[str],
+        compress: str = "DEFLATE",
+        tile_size: int = TILE_SIZE,
+        output_format: str = "GTiff",
+    ):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"Output format {output_format} is not one of {OUTPUT_FORMATS}."
+            )
+        self.image_name = image_name
+        self.profile = get_output_profile(output_profile, compress, tile_size)
+        self.band_descriptions = band_descriptions
+        self.cog = output_format == "COG"
+        self.d_s = None  # type: Optional[DatasetWriter]
+
+    @property
+    def write_name(self) -> str:
+        if self.cog:
+            return self.image_name + ".tmp.tif"
+        return self.image_name
+
+    def __enter__(self):
+        self.d_s = rasterio.open(self.write_name, "w", **self.profile)
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        for b_i, desc in enumerate(self.band_descriptions):
+            self.d_s.set_band_description(b_i + 1, desc)
+        if self.cog and exc_type is None:
+            factors = get_overview_factors(
+                self.profile["width"],
+                self.profile["height"],
+                self.profile["blockxsize"],
+            )
+            LOGGER.info(f"Building overviews with factors {factors}")
+            self.d_s.build_overviews(factors, Resampling.average)
+        self.d_s.close()
+        self.d_s = None
+        if self.cog:
+            if exc_type is None:
+                self.write_cog()
+            os.remove(self.write_name)
+
+    def write_cog(self):
+        LOGGER.info("Writing the Cloud-Optimized GeoTIFF")
+        options = {
+            "blocksize": self.profile["blockxsize"],
+            "overviews": "FORCE_USE_EXISTING",
+            "num_threads": "ALL_CPUS",
+            "BIGTIFF": "IF_SAFER",
+        }
+        if "compress" in self.profile:
+            options.update(
+                compress=self.profile["compress"], predictor=self.profile["predictor"]
+            )
+        rio_copy(self.write_name, self.image_name, driver="COG", **options)
+
+    def write(self, array: np.ndarray, window: Optional[Window] = None):
+        """
+        Writes a channel-last array into the given window of the output image,
+        or into the whole image if no window is given.
+        """
+        if self.d_s is None:
+            raise ValueError("The writer is not open, write inside its with block.")
+        if window is None:
+            window = Window(0, 0, self.profile["width"], self.profile["height"])
+        self.d_s.write(np.moveaxis(array, 2, 0), window=window)
+
+    def write_image(self, array: np.ndarray):
+        """
+        Writes a channel-last array of the size of the output image, one row of
+        tiles at a time.
+        """
+        tile_size = self.profile["blockysize"]
+        for row_off in range(0, array.shape[0], tile_size):
+            rows = array[row_off : row_off + tile_size]
+            self.write(rows, Window(0, row_off, rows.shape[1], rows.shape[0]))
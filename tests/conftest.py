@@ -0,0 +1,42 @@
+"""
+This module holds the fixtures shared by the test modules.
+"""
+import pytest
+
+from context import supres, ModelRegistry
+
+
+class LastInputModel:
+    """
+    Stand-in for the DSen2 models, which returns its last input, i.e. the upsampled
+    bands to super-resolve. It counts the predicted patches and their sizes. With
+    max_batch_size, larger batches fail like an allocation on a small device.
+    """
+
+    name = "last_input"
+
+    def __init__(self):
+        self.patches = 0
+        self.sizes = []  # type: list
+        self.max_batch_size = None
+        self.failures = 0
+
+    def predict(self, inputs, **kwargs):
+        if self.max_batch_size and len(inputs[0]) > self.max_batch_size:
+            self.failures += 1
+            raise MemoryError
+        self.patches += len(inputs[0])
+        self.sizes.append(inputs[0].shape[-1])
+        return inputs[-1]
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """Makes the model registry load the LastInputModel for all models."""
+    model = LastInputModel()
+    monkeypatch.setattr(
+        supres,
+        "MODEL_REGISTRY",
+        ModelRegistry(loader=lambda model_filename, *options: model),
+    )
+    return model
@@ -9,6 +9,12 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../s
 
 
 # pylint: disable=unused-import,wrong-import-position
-from s2_tiles_supres import Superresolution
-from supres import dsen2_60, dsen2_20, BatchGenerator
+from s2_tiles_supres import Superresolution, get_memory_limit
+from supres import dsen2_60, dsen2_20, BatchGenerator, ModelRegistry
+import supres
 import patches
+import writer
+import backends
+import datasets
+import inference
+import scene_cache
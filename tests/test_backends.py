@@ -0,0 +1,124 @@
+"""
+This module include test cases to check that the inference backends match the Keras model.
+"""
+import json
+
+import numpy as np
+import pytest
+from tensorflow import keras
+
+from context import backends, supres
+
+
+# pylint: disable=redefined-outer-name
+@pytest.fixture(scope="module")
+def model_filename(tmp_path_factory):
+    """
+    A tiny model with the inputs and outputs of DSen2: channel-first 10m and 20m
+    patches in, the residual on the 20m patches out.
+    """
+    input_10 = keras.Input((4, None, None))
+    input_20 = keras.Input((6, None, None))
+    features = keras.layers.Concatenate(axis=1)([input_10, input_20])
+    features = keras.layers.Permute((2, 3, 1))(features)
+    features = keras.layers.Conv2D(6, 3, padding="same")(features)
+    features = keras.layers.Permute((3, 1, 2))(features)
+    output = keras.layers.Add()([features, input_20])
+    model = keras.Model([input_10, input_20], output, name="tiny_dsen2")
+    path = tmp_path_factory.mktemp("weights") / "tiny_dsen2.hdf5"
+    model.save(str(path))
+    return str(path)
+
+
+@pytest.mark.parametrize("runtime", ["savedmodel", "tflite", "onnx"])
+def test_backend_parity(model_filename, runtime):
+    if runtime == "onnx":
+        pytest.importorskip("tf2onnx")
+        pytest.importorskip("onnxruntime")
+    rng = np.random.default_rng(0)
+    inputs = [
+        rng.uniform(0, 2, (3, 4, 32, 32)).astype(np.float32),
+        rng.uniform(0, 2, (3, 6, 32, 32)).astype(np.float32),
+    ]
+    keras_backend = backends.KerasBackend(
+        keras.models.load_model(model_filename, compile=False)
+    )
+
+    backend = backends.load_backend(model_filename, runtime, num_threads=2)
+    assert backend.name.endswith(backends.MODEL_SUFFIXES[runtime])
+    np.testing.assert_allclose(
+        backend.predict(inputs), keras_backend.predict(inputs), atol=1e-4
+    )
+    # The shapes of the batches can change between the calls.
+    smaller = [d[:2, :, :24, :24] for d in inputs]
+    np.testing.assert_allclose(
+        backend.predict(smaller), keras_backend.predict(smaller), atol=1e-4
+    )
+
+
+@pytest.mark.parametrize("runtime", ["keras", "savedmodel", "tflite", "onnx"])
+def test_integer_io_backend(model_filename, runtime):
+    if runtime == "onnx":
+        pytest.importorskip("tf2onnx")
+        pytest.importorskip("onnxruntime")
+    rng = np.random.default_rng(2)
+    inputs = [
+        rng.integers(0, 4000, (3, 4, 32, 32), dtype=np.uint16),
+        rng.integers(0, 4000, (3, 6, 32, 32), dtype=np.uint16),
+    ]
+    keras_backend = backends.KerasBackend(
+        keras.models.load_model(model_filename, compile=False)
+    )
+    expected = keras_backend.predict([d / np.float32(supres.SCALE) for d in inputs])
+    expected = np.clip(np.round(expected * supres.SCALE), 0, 65535)
+
+    backend = supres.load_model(model_filename, runtime, integer_io=True)
+    predictions = backend.predict(inputs)
+    assert predictions.dtype == np.uint16
+    np.testing.assert_allclose(predictions, expected, atol=1)
+
+
+@pytest.mark.parametrize("precision", ["float16", "dynamic", "int8"])
+def test_quantized_backend(model_filename, precision):
+    rng = np.random.default_rng(1)
+    calibration = [
+        rng.uniform(0, 2, (8, 4, 32, 32)).astype(np.float32),
+        rng.uniform(0, 2, (8, 6, 32, 32)).astype(np.float32),
+    ]
+    model = supres.load_model(model_filename, "tflite", precision, calibration)
+    model_path = backends.get_model_path(model_filename, "tflite", precision)
+    assert model.name == model_path.rsplit("/", 1)[-1]
+    assert model_path.endswith(f".{precision}.tflite")
+
+    with open(model_path.replace(".tflite", ".json")) as report_file:
+        report = json.load(report_file)
+    assert len(report["rmse_per_band"]) == 6
+    # Within 0.05 of the float32 model on outputs around 1, in DN of SCALE.
+    assert report["rmse"] < 0.05 * supres.SCALE
+    assert 0 <= report["sam_degrees"] < 5
+
+    with pytest.raises(ValueError):
+        backends.convert_model(model_filename, "onnx", precision=precision)
+
+
+def test_accuracy_report():
+    expected = np.ones((2, 3, 4, 4))
+    report = backends.accuracy_report(expected, expected * 1.1, scale=10)
+    np.testing.assert_allclose(report["rmse"], 1)
+    np.testing.assert_allclose(report["rmse_per_band"], [1, 1, 1])
+    np.testing.assert_allclose(report["sam_degrees"], 0, atol=1e-6)
+
+    rotated = expected.copy()
+    rotated[:, 0] = 0
+    report = backends.accuracy_report(expected[:, :2], rotated[:, :2])
+    np.testing.assert_allclose(report["sam_degrees"], 45)
+
+
+def test_backend_is_abstract():
+    class NoPredictBackend(backends.Backend):
+        pass
+
+    with pytest.raises(TypeError):
+        backends.Backend("model")
+    with pytest.raises(TypeError):
+        NoPredictBackend("model")
@@ -0,0 +1,47 @@
+"""
+This module include test cases for the datasets script.
+"""
+from pathlib import Path
+import tempfile
+import threading
+
+from rasterio.transform import from_origin
+from fake_geo_images.fakegeoimages import FakeGeoImage
+
+from context import datasets
+
+
+def test_dataset_cache():
+    test_dir = Path(tempfile.mkdtemp())
+    valid_desc = [
+        "B4, central wavelength 665 nm",
+        "B3, central wavelength 560 nm",
+        "B2, central wavelength 490 nm",
+        "B8, central wavelength 842 nm",
+    ]
+    transform = from_origin(1470996, 6914001, 10.0, 10.0)
+    test_img, _ = FakeGeoImage(20, 18, 4, "uint16", test_dir, 32640).create(
+        seed=45, transform=transform, band_desc=valid_desc
+    )
+
+    cache = datasets.DatasetCache()
+    with cache:
+        d_s = cache.open(test_img)
+        assert cache.open(test_img) is d_s
+        meta = cache.meta(test_img)
+        assert cache.meta(test_img) is meta
+        assert (meta.width, meta.height, meta.band_count) == (20, 18, 4)
+        assert meta.transform == transform
+        assert meta.crs.to_epsg() == 32640
+        assert meta.descriptions == tuple(valid_desc)
+        assert cache.opened == 1
+
+        handles = []
+        thread = threading.Thread(target=lambda: handles.append(cache.open(test_img)))
+        thread.start()
+        thread.join()
+        assert handles[0] is not d_s
+        assert cache.opened == 2
+
+    assert d_s.closed
+    assert not cache.handles and not cache.metas
@@ -0,0 +1,104 @@
+"""
+This module include test cases to check the scene-level processing of the inference
+script, with stand-in models.
+"""
+from unittest import mock
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from fake_geo_images.fakegeoimages import FakeGeoImage
+
+from context import inference, datasets
+
+DESCRIPTIONS = {
+    "10m": ["B4, central wavelength 665 nm", "B3, central wavelength 560 nm"]
+    + ["B2, central wavelength 490 nm", "B8, central wavelength 842 nm"],
+    "20m": ["B5, central wavelength 705 nm", "B6, central wavelength 740 nm"]
+    + ["B7, central wavelength 783 nm", "B8A, central wavelength 865 nm"]
+    + ["B11, central wavelength 1610 nm", "B12, central wavelength 2190 nm"],
+    "60m": ["B1, central wavelength 443 nm", "B9, central wavelength 945 nm"],
+}
+
+
+def make_scene(path, size):
+    """Writes the 10m, 20m and 60m rasters of a scene of size 10m pixels."""
+    data_list = []
+    for resolution, factor in [("10m", 1), ("20m", 2), ("60m", 6)]:
+        res_dir = path / resolution
+        res_dir.mkdir()
+        bands = len(DESCRIPTIONS[resolution])
+        test_img, _ = FakeGeoImage(
+            size // factor, size // factor, bands, "uint16", res_dir, 32633
+        ).create(
+            seed=45,
+            transform=from_origin(300000, 5000000, 10.0 * factor, 10.0 * factor),
+            band_desc=DESCRIPTIONS[resolution],
+        )
+        data_list.append(str(test_img))
+    return data_list
+
+
+def run_scene(data_list, output_dir, params, name="output.tif"):
+    """Super-resolves the scene with params and returns the output image and the
+    processor."""
+    processor = inference.SuperresolutionProcess(params, output_dir=f"{output_dir}/")
+    with mock.patch.object(
+        processor, "get_data", return_value=(data_list, "MSIL1C")
+    ), datasets.DATASET_CACHE:
+        processor.process_scene("S2A_MSIL1C", name)
+    with rasterio.open(output_dir / name) as d_s:
+        return d_s.read(), processor
+
+
+# pylint: disable=unused-argument
+def test_auto_tune_streaming_small_blocks(tmp_path, fake_model):
+    """
+    Checks that a patch size tuned on a large block is not used for the smaller
+    edge blocks it does not fit.
+    """
+    data_list = make_scene(tmp_path, 420)
+    params = {
+        "streaming": True,
+        "block_size": 360,
+        "auto_tune": True,
+        "memory_budget_gb": 100,
+    }
+    image, processor = run_scene(data_list, tmp_path, params)
+    assert image.shape == (8, 420, 420)
+    assert processor.tuned_patch_sizes == {"20m": 384, "60m": 384}
+
+
+@pytest.mark.parametrize(
+    "params, bands",
+    [
+        ({"streaming": True, "block_size": 240}, list(range(8))),
+        ({"fused_models": True}, list(range(8))),
+        ({"output_bands": ["B5", "B12", "B9"]}, [0, 5, 7]),
+        (
+            {
+                "streaming": True,
+                "block_size": 240,
+                "fused_models": True,
+                "output_bands": ["B6", "B1"],
+            },
+            [1, 6],
+        ),
+    ],
+)
+# pylint: disable=unused-argument
+def test_process_scene_modes(tmp_path, fake_model, params, bands):
+    """
+    Checks that the streaming and the fused modes give the output of the default
+    in-memory, sequential mode, and that output_bands selects the output bands.
+    """
+    data_list = make_scene(tmp_path, 420)
+    expected, _ = run_scene(data_list, tmp_path, {}, name="expected.tif")
+    assert expected.shape == (8, 420, 420)
+    assert expected.std() > 0
+
+    image, _ = run_scene(data_list, tmp_path, params)
+    assert image.shape == (len(bands), 420, 420)
+    np.testing.assert_array_equal(image, expected[bands])
@@ -5,6 +5,7 @@ import numpy as np
 from context import patches
 from test_supres import DISABLE_NO_GPU
 
+
 # pylint: disable=redefined-outer-name
 @pytest.fixture()
 def dset_10():
@@ -86,3 +87,174 @@ def test_get_test_patches_wrong_number():
     assert r_60[0].shape == (16, 4, 192, 192)
     assert r_60[1].shape == (16, 6, 192, 192)
     assert r_60[2].shape == (16, 2, 192, 192)
+
+
+def test_patch_grid():
+    dset = np.arange(60 * 50 * 3, dtype=np.uint16).reshape((60, 50, 3))
+    grid = patches.get_patch_grid(dset, 20, 4, 4, 3)
+    assert grid.shape == (20, 3, 20, 20)
+    assert np.shares_memory(grid.view, dset)
+
+    expected = np.stack(
+        [
+            patches.crop_array_to_window(dset, patches.get_crop_window(i, j, 20))
+            for i in [0, 12, 24, 36, 40]
+            for j in [0, 12, 24, 30]
+        ]
+    )
+    materialized = patches.get_patches(dset, 20, 4, 4, 3)
+    assert materialized.dtype == np.uint16
+    np.testing.assert_array_equal(materialized, expected)
+    np.testing.assert_array_equal(grid[5:9], expected[5:9])
+    np.testing.assert_array_equal(grid[7, :, 4:16, 4:16], expected[7, :, 4:16, 4:16])
+    np.testing.assert_array_equal(np.asarray(grid, dtype=np.float32), expected)
+    assert not grid.view.flags.writeable
+    with pytest.raises(ValueError):
+        patches.PatchGrid(dset, 64, np.array([0]), np.array([0]))
+
+
+def test_interp_image_matches_interp_patches():
+    rng = np.random.default_rng(42)
+    dset_10 = rng.integers(0, 10000, (240, 216, 4)).astype(np.uint16)
+    dset_20 = rng.integers(0, 10000, (120, 108, 6)).astype(np.uint16)
+    dset_60 = rng.integers(0, 10000, (40, 36, 2)).astype(np.uint16)
+
+    _, p20 = patches.get_test_patches(dset_10, dset_20, 128, 8)
+    _, lr20 = patches.get_test_patches(dset_10, dset_20, 128, 8, interp=False)
+    ref20 = patches.interp_patches(lr20[:], p20.shape)
+    np.testing.assert_allclose(p20[:, :, 8:-8, 8:-8], ref20[:, :, 8:-8, 8:-8], atol=0.1)
+
+    _, _, p60 = patches.get_test_patches60(dset_10, dset_20, dset_60, 192, 12)
+    _, _, lr60 = patches.get_test_patches60(
+        dset_10, dset_20, dset_60, 192, 12, interp=False
+    )
+    ref60 = patches.interp_patches(lr60[:], p60.shape)
+    np.testing.assert_allclose(
+        p60[:, :, 12:-12, 12:-12], ref60[:, :, 12:-12, 12:-12], atol=0.1
+    )
+
+
+@pytest.mark.parametrize("shape, patch_size", [((224, 224), 128), ((100, 90), 40)])
+def test_recompose_images_placement(shape, patch_size):
+    """
+    Checks that the patches cut from a known image are put back in place, also
+    when the patch core divides the image size.
+    """
+    image = np.random.default_rng(3).uniform(0, 1, shape + (2,)).astype(np.float32)
+    padded = np.pad(image, ((8, 8), (8, 8), (0, 0)), mode="reflect")
+    core = patch_size - 16
+    grid = patches.get_patch_grid(
+        padded, patch_size, 8, shape[0] // core, shape[1] // core
+    )
+    np.testing.assert_array_equal(
+        patches.recompose_images(grid[:], 8, image.shape), image
+    )
+
+
+def test_mosaic():
+    rng = np.random.default_rng(0)
+    image = rng.uniform(0, 30, (100, 90, 2)).astype(np.float32)
+    padded = np.pad(image, ((8, 8), (8, 8), (0, 0)), mode="reflect")
+    grid = patches.get_patch_grid(padded, 40, 8, 4, 3)
+    predictions = grid[:]
+    # Out of range values are clipped to the range of uint16.
+    predictions[0, :, 8:10, 8:10] = -0.1
+    predictions[-1, :, -10:-8, -10:-8] = 40
+    mosaic = patches.Mosaic(image.shape, 8, grid.origins_i, grid.origins_j, scale=2000)
+    mosaic.add(predictions[:7])
+    mosaic.add(predictions[7:])
+    assert mosaic.image.shape == (100, 90, 2)
+    assert mosaic.image.dtype == np.uint16
+
+    expected = (image * 2000).astype(np.uint16)
+    expected[:2, :2] = 0
+    expected[-2:, -2:] = 65535
+    np.testing.assert_array_equal(mosaic.image, expected)
+
+    # With min_value, no prediction takes the nodata value 0.
+    for dtype, scale in [(np.float32, 2000), (np.uint16, 1)]:
+        mosaic = patches.Mosaic(
+            image.shape, 8, grid.origins_i, grid.origins_j, scale=scale, min_value=1
+        )
+        mosaic.add(np.clip(predictions, 0, None).astype(dtype))
+        assert mosaic.image.min() == 1
+        assert (mosaic.image[:2, :2] == 1).all()
+
+
+def test_tile_plan():
+    rng = np.random.default_rng(7)
+    dset_10 = rng.integers(0, 10000, (240, 216, 4)).astype(np.uint16)
+    dset_20 = rng.integers(0, 10000, (120, 108, 6)).astype(np.uint16)
+    dset_60 = rng.integers(0, 10000, (40, 36, 2)).astype(np.uint16)
+
+    plan = patches.TilePlan(dset_10, dset_20, dset_60, border=12, scale=2000)
+    p10_20, p20 = plan.grids(128, 8)
+    p10_60, p20_60, p60 = plan.grids(192, 12, with_60m=True)
+    assert plan.shape == dset_10.shape
+    assert p10_20.dtype == p20.dtype == p60.dtype == np.float32
+    assert np.shares_memory(p10_20.view, p10_60.view)
+    assert np.shares_memory(p20.view, p20_60.view)
+
+    r_20 = patches.get_test_patches(dset_10, dset_20, 128, 8)
+    r_60 = patches.get_test_patches60(dset_10, dset_20, dset_60, 192, 12)
+    assert p10_20.shape == r_20[0].shape
+    np.testing.assert_array_equal(p10_20.origins_i, r_20[0].origins_i)
+    np.testing.assert_allclose(p10_20[:], r_20[0][:] / 2000, rtol=1e-6)
+    # Only the outermost mirrored row and column of the 20m input can differ.
+    np.testing.assert_allclose(
+        p20[:, :, 1:-1, 1:-1], r_20[1][:, :, 1:-1, 1:-1] / 2000, rtol=1e-6
+    )
+    for grid, expected in zip([p10_60, p20_60, p60], r_60):
+        np.testing.assert_allclose(grid[:], expected[:] / 2000, rtol=1e-6)
+
+    assert len(p10_20) == patches.count_patches(dset_10.shape, "20m", 128, 8)
+    assert len(p60) == patches.count_patches(dset_10.shape, "60m", 192, 12)
+
+    with pytest.raises(ValueError):
+        plan.grids(128, 16)
+    with pytest.raises(ValueError):
+        patches.TilePlan(dset_10, dset_20, border=8).grids(192, 6, with_60m=True)
+
+    # The plan of the models with integer inputs keeps the uint16 data.
+    plan = patches.TilePlan(dset_10, dset_20, dset_60, border=12, keep_dtype=True)
+    p10, p20, p60 = plan.grids(192, 12, with_60m=True)
+    assert p10.dtype == p20.dtype == p60.dtype == np.uint16
+    for grid, expected in zip([p10, p20, p60], r_60):
+        np.testing.assert_allclose(grid[:], expected[:], atol=0.5)
+
+
+def test_tile_plan_valid_patches():
+    dset_10 = np.ones((240, 216, 4), dtype=np.uint16)
+    dset_10[:112] = 0
+    dset_10[150, 3, 2] = 0
+    dset_20 = np.ones((120, 108, 6), dtype=np.uint16)
+
+    plan = patches.TilePlan(dset_10, dset_20, border=8, nodata=0)
+    p10, p20 = plan.grids(128, 8)
+    keep = plan.valid_patches(p10, 128, 8)
+    # Only the first row of patch cores (rows 0 to 111) is entirely nodata.
+    assert len(p10) == 6
+    np.testing.assert_array_equal(keep, np.arange(2, 6))
+    assert plan.valid[150, 3]
+    assert not plan.valid[:112].any()
+
+    selected = p20.select(keep)
+    assert selected.shape == (4,) + p20.shape[1:]
+    np.testing.assert_array_equal(selected[:], p20[2:])
+
+    # A mask, e.g. of the AOI polygon, leaves out the patches outside of it.
+    mask = np.zeros(dset_10.shape[:2], dtype=bool)
+    mask[200:, 200:] = True
+    plan = patches.TilePlan(dset_10, dset_20, border=8, nodata=0, mask=mask)
+    np.testing.assert_array_equal(plan.valid_patches(p10, 128, 8), [3, 5])
+    assert plan.valid.sum() == 40 * 16
+    assert (
+        patches.TilePlan(dset_10, dset_20, border=8).valid_patches(p10, 128, 8) is None
+    )
+
+    # Pixels with any of several nodata values in all bands are nodata.
+    dset_10[200:] = 65535
+    dset_10[210, 5] = [0, 65535, 0, 65535]
+    plan = patches.TilePlan(dset_10, dset_20, border=8, nodata=(65535, 0))
+    assert not plan.valid[:112].any() and not plan.valid[200:].any()
+    assert plan.valid[112:200].all()
@@ -1,16 +1,24 @@
 """
 This module include multiple test cases to check the performance of the s2_tiles_supres script.
 """
+from concurrent.futures import ThreadPoolExecutor
+import json
 from pathlib import Path
 import tempfile
+from unittest import mock
 
+import numpy as np
+import pytest
 import rasterio
 from rasterio.transform import from_origin
+from rasterio.windows import Window
 
 from fake_geo_images.fakegeoimages import FakeGeoImage
+from pyproj import Transformer
 from blockutils.logging import get_logger
+from blockutils.exceptions import UP42Error, SupportedErrors
 
-from context import Superresolution
+from context import Superresolution, get_memory_limit
 
 logger = get_logger(__name__)
 
@@ -77,6 +85,10 @@ def test_to_xy():
     assert dsr_x == dsr_x_exm
     assert dsr_y == dsr_y_exm
 
+    dsr_x, dsr_y = s_2.to_xy(np.array([1, 1]), np.array([40, 40]), test_img)
+    np.testing.assert_array_equal(dsr_x, [dsr_x_exm] * 2)
+    np.testing.assert_array_equal(dsr_y, [dsr_y_exm] * 2)
+
 
 def test_get_utm():
     """
@@ -250,6 +262,76 @@ def test_data_final():
     d_final = Superresolution.data_final(test_img, valid_indices, 0, 0, 5, 5, 1, 1)
     assert d_final.shape == (6, 6, 4)
 
+    d_final = Superresolution.data_final(test_img, [3, 1], 6, 0, 17, 5, 1, 1)
+    assert d_final.shape == (6, 12, 2)
+    assert d_final.flags["C_CONTIGUOUS"]
+    with rasterio.open(test_img) as d_s:
+        expected = d_s.read()[[3, 1], 0:6, 6:18]
+    np.testing.assert_array_equal(d_final, np.moveaxis(expected, 0, 2))
+
+
+def test_read_data():
+    """
+    This method checks that the concurrent read_data matches data_final.
+    """
+    test_dir = Path(tempfile.mkdtemp())
+    valid_desc = [
+        "B4, central wavelength 665 nm",
+        "B3, central wavelength 560 nm",
+        "B2, central wavelength 490 nm",
+        "B8, central wavelength 842 nm",
+    ]
+    transform = from_origin(1470996, 6914001, 10.0, 10.0)
+    test_img, _ = FakeGeoImage(24, 18, 4, "uint16", test_dir).create(
+        seed=45, transform=transform, band_desc=valid_desc
+    )
+    assert Superresolution({"read_threads": None}).read_threads >= 1
+    s_2 = Superresolution({"read_threads": 3})
+    assert s_2.read_threads == 3
+    datasets = [(test_img, [0, 2, 3], 1), (test_img, [1], 2)]
+
+    expected = s_2.read_data(datasets, 0, 0, 11, 5)
+    with ThreadPoolExecutor(3) as executor:
+        result = s_2.read_data(datasets, 0, 0, 11, 5, executor)
+    assert [r.shape for r in result] == [(6, 12, 3), (3, 6, 1)]
+    for res, exp in zip(result, expected):
+        np.testing.assert_array_equal(res, exp)
+
+    s_2 = Superresolution({"scene_cache_dir": str(test_dir / "cache")})
+    s_2.product_id = "S2A_MSIL1C"
+    for _ in range(2):
+        result = s_2.read_data(datasets, 0, 0, 11, 5)
+        for res, exp in zip(result, expected):
+            np.testing.assert_array_equal(res, exp)
+    assert (s_2.scene_cache.hits, s_2.scene_cache.misses) == (4, 4)
+
+
+def test_get_blocks():
+    """
+    This method checks that get_blocks covers the region with 60m aligned blocks.
+    """
+    blocks = Superresolution.get_blocks(0, 0, 395, 197, block_size=204, overlap=12)
+    assert blocks == [
+        ((0, 0, 215, 197), Window(col_off=0, row_off=0, width=204, height=198)),
+        ((192, 0, 395, 197), Window(col_off=204, row_off=0, width=192, height=198)),
+    ]
+
+    xmin, ymin, xmax, ymax = 6, 12, 1097, 1553
+    blocks = Superresolution.get_blocks(xmin, ymin, xmax, ymax, block_size=500)
+    covered = np.zeros((ymax - ymin + 1, xmax - xmin + 1), dtype=int)
+    for read_bounds, core in blocks:
+        assert all(b % 6 == 0 for b in read_bounds[:2])
+        assert all((b + 1) % 6 == 0 for b in read_bounds[2:])
+        assert read_bounds[2] - read_bounds[0] + 1 >= 192
+        assert read_bounds[3] - read_bounds[1] + 1 >= 192
+        assert read_bounds[0] <= core.col_off + xmin
+        assert read_bounds[2] >= core.col_off + xmin + core.width - 1
+        covered[core.toslices()] += 1
+    assert (covered == 1).all()
+
+    blocks = Superresolution.get_blocks(0, 0, 395, 197, 204, 12, min_size=264)
+    assert all(read_bounds[2] - read_bounds[0] + 1 >= 264 for read_bounds, _ in blocks)
+
 
 def test_from_dict():
     """
@@ -263,3 +345,218 @@ def test_from_dict():
     }
     supres = Superresolution.from_dict(params)
     assert isinstance(supres, Superresolution)
+
+
+def test_run_in_process_maps_exit_codes():
+    """
+    Checks that failures of the in-process inference are mapped to UP42Error codes.
+    """
+    supres = Superresolution.from_dict({"in_process": True})
+    run_feature = supres.run_in_process()
+
+    with mock.patch(
+        "inference.SuperresolutionProcess.get_data",
+        side_effect=UP42Error(SupportedErrors.NO_INPUT_ERROR),
+    ):
+        with pytest.raises(UP42Error) as e:
+            run_feature("input_id", "input_id_superresolution.tif")
+    assert e.value.error_code == SupportedErrors.NO_INPUT_ERROR
+
+
+def test_assert_input_params_output_bands():
+    """
+    Checks the validation of the output_bands parameter.
+    """
+    Superresolution({"output_bands": ["B5", "B9"]}).assert_input_params()
+    Superresolution({"output_bands": None}).assert_input_params()
+    for output_bands in [[], ["B2"], "B5"]:
+        with pytest.raises(UP42Error) as e:
+            Superresolution({"output_bands": output_bands}).assert_input_params()
+        assert e.value.error_code == SupportedErrors.INPUT_PARAMETERS_ERROR
+
+
+def test_assert_input_params_patch_sizes():
+    """
+    Checks that the patch sizes and borders are aligned to the grid of each model.
+    """
+    Superresolution(
+        {"patch_size_20m": 256, "border_20m": 10, "patch_size_60m": 384}
+    ).assert_input_params()
+    for params in [
+        {"patch_size_20m": 129},
+        {"patch_size_60m": 200},
+        {"border_60m": 8},
+        {"patch_size_20m": 16, "border_20m": 8},
+        {"border_20m": "8"},
+    ]:
+        with pytest.raises(UP42Error) as e:
+            Superresolution(params).assert_input_params()
+        assert e.value.error_code == SupportedErrors.INPUT_PARAMETERS_ERROR
+
+
+def test_assert_input_params_runtime():
+    """
+    Checks the validation of the runtime parameter.
+    """
+    Superresolution({"runtime": "tflite"}).assert_input_params()
+    with pytest.raises(UP42Error) as e:
+        Superresolution({"runtime": "torch"}).assert_input_params()
+    assert e.value.error_code == SupportedErrors.INPUT_PARAMETERS_ERROR
+
+    # A runtime is rejected up front if a package it needs is not installed.
+    with mock.patch.dict(
+        "backends.RUNTIME_PACKAGES", {"tflite": ["not_an_installed_package"]}
+    ):
+        with pytest.raises(UP42Error) as e:
+            Superresolution({"runtime": "tflite"}).assert_input_params()
+    assert e.value.error_code == SupportedErrors.INPUT_PARAMETERS_ERROR
+    assert "not_an_installed_package" in str(e.value)
+
+
+def test_assert_input_params_model_precision():
+    """
+    Checks that quantized models are only accepted with the tflite runtime, and
+    int8 models only without integer_io.
+    """
+    params = {"model_precision": "int8", "runtime": "tflite"}
+    Superresolution(params).assert_input_params()
+    for params in [
+        {"model_precision": "int8"},
+        {"model_precision": "int4", "runtime": "tflite"},
+        {"model_precision": "int8", "runtime": "tflite", "integer_io": True},
+    ]:
+        with pytest.raises(UP42Error) as e:
+            Superresolution(params).assert_input_params()
+        assert e.value.error_code == SupportedErrors.INPUT_PARAMETERS_ERROR
+
+
+def test_preflight():
+    """
+    Checks the preflight window, bands and cost estimate, computed from the
+    metadata of the raster files only.
+    """
+    test_dir = Path(tempfile.mkdtemp())
+    descriptions = {
+        "10m": ["B4, central wavelength 665 nm", "B3, central wavelength 560 nm"]
+        + ["B2, central wavelength 490 nm", "B8, central wavelength 842 nm"],
+        "20m": ["B5, central wavelength 705 nm", "B6, central wavelength 740 nm"]
+        + ["B7, central wavelength 783 nm", "B8A, central wavelength 865 nm"]
+        + ["B11, central wavelength 1610 nm", "B12, central wavelength 2190 nm"],
+        "60m": ["B1, central wavelength 443 nm", "B9, central wavelength 945 nm"],
+    }
+    data_list = []
+    for resolution, factor in [("10m", 1), ("20m", 2), ("60m", 6)]:
+        res_dir = test_dir / resolution
+        res_dir.mkdir()
+        bands = len(descriptions[resolution])
+        test_img, _ = FakeGeoImage(
+            240 // factor, 240 // factor, bands, "uint16", res_dir
+        ).create(
+            seed=45,
+            transform=from_origin(1470996, 6914001, 10.0 * factor, 10.0 * factor),
+            band_desc=descriptions[resolution],
+        )
+        data_list.append(str(test_img))
+
+    def preflight(params):
+        s_2 = Superresolution(params)
+        with mock.patch.object(s_2, "get_data", return_value=(data_list, "MSIL1C")):
+            return s_2.preflight("S2A_MSIL1C")
+
+    estimate = preflight({"memory_budget_gb": 1})
+    assert estimate["window"] == [0, 0, 239, 239]
+    assert estimate["sr_bands"] == ["B5", "B6", "B7", "B8A", "B11", "B12", "B1", "B9"]
+    assert estimate["pixels"] == 240 * 240
+    assert estimate["patches"] == {"20m": 9, "60m": 4}
+    assert estimate["blocks"] == 1
+    assert estimate["memory_bytes"] > 0
+
+    estimate_20m = preflight({"memory_budget_gb": 1, "output_bands": ["B5"]})
+    assert estimate_20m["patches"] == {"20m": 9}
+    assert estimate_20m["memory_bytes"] < estimate["memory_bytes"]
+
+    with pytest.raises(UP42Error) as e:
+        preflight({"patch_size_60m": 264})
+    assert e.value.error_code == SupportedErrors.INPUT_PARAMETERS_ERROR
+
+
+def test_aoi_mask():
+    """
+    Checks that the region covers all vertices of a polygon AOI and that only the
+    pixels touching the polygon are in the mask.
+    """
+    test_dir = Path(tempfile.mkdtemp())
+    valid_desc = [
+        "B4, central wavelength 665 nm",
+        "B3, central wavelength 560 nm",
+        "B2, central wavelength 490 nm",
+        "B8, central wavelength 842 nm",
+    ]
+    transform = from_origin(1470996, 6914001, 10.0, 10.0)
+    test_img, _ = FakeGeoImage(60, 60, 4, "uint16", test_dir, 32640).create(
+        seed=45, transform=transform, band_desc=valid_desc
+    )
+    # A triangle over the upper left half of the image, in longitude and latitude.
+    to_lonlat = Transformer.from_crs("epsg:32640", "epsg:4326", always_xy=True)
+    corners = [(1471061, 6913936), (1471541, 6913936), (1471061, 6913456)]
+    polygon = {
+        "type": "Polygon",
+        "coordinates": [[list(to_lonlat.transform(*c)) for c in corners + corners[:1]]],
+    }
+    s_2 = Superresolution({"intersects": polygon, "clip_to_aoi": True})
+
+    xmin, ymin, xmax, ymax, _ = s_2.area_of_interest(test_img)
+    assert (xmin, ymin, xmax, ymax) == (6, 6, 53, 53)
+    mask = s_2.aoi_mask(test_img, (xmin, ymin, xmax, ymax))
+    assert mask.shape == (48, 48)
+    assert mask[0].all() and mask[:, 0].all()
+    assert not mask[-1, -1] and not mask[2:, -1].any()
+    assert 0.5 <= mask.mean() < 0.6
+
+    s_2 = Superresolution({"intersects": polygon})
+    assert s_2.aoi_mask(test_img, (0, 0, 5, 5)) is None
+
+
+def test_get_memory_limit(tmp_path):
+    """
+    Checks that the memory limit of the container's cgroup caps the physical memory.
+    """
+    physical = get_memory_limit([])
+    assert physical > 0
+
+    cgroup_v2 = tmp_path / "memory.max"
+    cgroup_v2.write_text("max\n")
+    assert get_memory_limit([str(cgroup_v2)]) == physical
+    cgroup_v2.write_text(f"{2 * 1024 ** 3}\n")
+    assert get_memory_limit([str(cgroup_v2)]) == min(physical, 2 * 1024 ** 3)
+
+    # cgroup v1 reports a huge value without a limit.
+    cgroup_v1 = tmp_path / "memory.limit_in_bytes"
+    cgroup_v1.write_text(f"{2 ** 63 - 4096}\n")
+    assert get_memory_limit([str(tmp_path / "missing"), str(cgroup_v1)]) == physical
+
+
+def test_manifest_declares_params():
+    """
+    Checks that every block parameter is declared in the manifest, as UP42 only
+    passes the declared parameters to the block.
+    """
+    manifest_path = Path(__file__).resolve().parents[1] / "UP42Manifest.json"
+    with open(manifest_path) as src:
+        declared = set(json.load(src)["parameters"])
+    # The STAC query parameters of blockutils besides bbox, intersects and contains.
+    stac_params = {"ids", "limit", "time", "time_series"}
+    assert set(Superresolution({}).params.__dict__) - declared == stac_params
+
+
+def test_get_batch_budget():
+    """
+    Checks that the batches are only sized from the memory budget when a budget or
+    the auto-tune mode is set.
+    """
+    assert Superresolution({}).get_batch_budget(2, True) is None
+    s_2 = Superresolution({"memory_budget_gb": 1})
+    assert s_2.get_batch_budget(2, False) == 1024 ** 3
+    assert s_2.get_batch_budget(2, True) == 1024 ** 3 // 2
+    s_2 = Superresolution({"auto_tune": True})
+    assert s_2.get_batch_budget(1, False) == s_2.memory_budget
@@ -0,0 +1,32 @@
+"""
+This module include test cases for the scene_cache script.
+"""
+import os
+from pathlib import Path
+import tempfile
+
+import numpy as np
+
+from context import scene_cache
+
+
+def test_scene_cache():
+    cache_dir = Path(tempfile.mkdtemp())
+    band = np.arange(100 * 100, dtype=np.uint16).reshape((100, 100))
+    cache = scene_cache.SceneCache(str(cache_dir), max_bytes=2 * band.nbytes + 500)
+
+    cached = cache.get("S2A_1", "B5_20m", lambda: band)
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, band)
+    cached = cache.get("S2A_1", "B5_20m", lambda: None)
+    np.testing.assert_array_equal(cached[10:20, 30:40], band[10:20, 30:40])
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.get("S2A_1", "B6_20m", lambda: band + 1)
+    os.utime(cache.path("S2A_1", "B5_20m"), (0, 0))
+    cache.get("S2A_2", "B5_20m", lambda: band + 2)
+    assert not cache.path("S2A_1", "B5_20m").exists()
+    assert cache.path("S2A_1", "B6_20m").exists()
+    assert cache.path("S2A_2", "B5_20m").exists()
+    assert cache.size() <= cache.max_bytes
+    assert not list(cache_dir.glob("*/*.tmp"))
@@ -1,16 +1,22 @@
 """
 This module include multiple test cases to check the performance of the s2_tiles_supres script.
 """
+
+import os
+import subprocess
+import sys
+
 import tensorflow as tf
 import numpy as np
 import pytest
-from context import dsen2_60, dsen2_20, BatchGenerator, patches
+from context import dsen2_60, dsen2_20, BatchGenerator, ModelRegistry, patches, supres
 
 DISABLE_NO_GPU = pytest.mark.skipif(
     len(tf.config.list_physical_devices("GPU")) == 0,
     reason="Conv2D op requires GPU for channels first configuration.",
 )
 
+
 # pylint: disable=redefined-outer-name
 @pytest.fixture
 def level1():
@@ -65,3 +71,186 @@ def test_batch_generator(d10, d20):
     assert len(a_one) == 2
     assert a_one[0].shape == (625, 4, 128, 128)
     assert a_one[1].shape == (625, 6, 128, 128)
+
+
+def test_model_registry():
+    loaded = []
+
+    def loader(model_filename, runtime, precision, calibration, integer_io):
+        loaded.append((model_filename, runtime, integer_io))
+        assert calibration is None or precision != "float32"
+        return model_filename
+
+    registry = ModelRegistry(max_models=2, loader=loader)
+    model_20 = registry.get("20m", "MSIL1C")
+    assert registry.get("20m", "MSIL1C") is model_20
+    registry.get("60m", "MSIL2A")
+    registry.get("60m", "MSIL2Ap")
+    assert registry.stats() == {
+        "loaded": 2,
+        "loads": 2,
+        "hits": 2,
+        "misses": 2,
+        "evictions": 0,
+    }
+
+    registry.get("60m", "MSIL1C")
+    assert registry.stats()["evictions"] == 1
+    registry.get("20m", "MSIL1C")
+    assert loaded.count((model_20, "keras", False)) == 2
+    assert registry.stats()["loads"] == 4
+    registry.get("20m", "MSIL1C", "tflite")
+    assert loaded[-1] == (model_20, "tflite", False)
+    registry.get("20m", "MSIL1C", "tflite", integer_io=True)
+    assert loaded[-1] == (model_20, "tflite", True)
+
+    with pytest.raises(ValueError):
+        registry.get("10m", "MSIL1C")
+
+
+def test_prefetch():
+    assert list(supres.prefetch(iter(range(10)), 3)) == list(range(10))
+    assert list(supres.prefetch(iter(range(10)), 0)) == list(range(10))
+
+    def failing():
+        yield 1
+        raise ValueError("producer failed")
+
+    items = []
+    with pytest.raises(ValueError):
+        for item in supres.prefetch(failing(), 2):
+            items.append(item)
+    assert items == [1]
+
+
+def test_predict_pipeline(fake_model):
+    d10 = np.random.randint(1, 10000, size=(300, 260, 4)).astype(np.uint16)
+    d20 = np.random.randint(1, 10000, size=(150, 130, 6)).astype(np.uint16)
+    test = patches.get_test_patches(d10, d20, patch_size=128, border=8)
+
+    images = []
+    for queue_depth in [0, 1, 3]:
+        mosaic = patches.Mosaic(
+            d10.shape, 8, test[0].origins_i, test[0].origins_j, scale=supres.SCALE
+        )
+        supres._predict(test, fake_model, mosaic, queue_depth)
+        images.append(mosaic.image)
+    assert images[0].shape == (300, 260, 6)
+    np.testing.assert_array_equal(images[0], images[1])
+    np.testing.assert_array_equal(images[0], images[2])
+
+
+def test_tune_patch_size(fake_model):
+    d10 = np.random.randint(1, 10000, size=(300, 264, 4)).astype(np.uint16)
+    d20 = np.random.randint(1, 10000, size=(150, 132, 6)).astype(np.uint16)
+    plan = patches.TilePlan(d10, d20, border=8, scale=supres.SCALE)
+
+    budget = supres.estimate_batch_memory(128, 10, supres.BATCH_SIZE)
+    patch_size = supres.tune_patch_size(
+        plan, "20m", "MSIL1C", 8, budget, candidates=[64, 100, 127, 128, 192, 384]
+    )
+    assert patch_size in [64, 100, 128]
+    # Each fitting candidate is predicted twice, the others are skipped.
+    assert sorted(set(fake_model.sizes)) == [64, 100, 128]
+    assert len(fake_model.sizes) == 6
+
+    image = supres.dsen2_20(
+        None, None, "MSIL1C", plan=plan, patch_size=patch_size, border=8
+    )
+    assert image.shape == (300, 264, 6)
+
+
+def test_dsen2_20_skips_nodata_patches(fake_model):
+    d10 = np.random.randint(1, 10000, size=(240, 216, 4)).astype(np.uint16)
+    d20 = np.random.randint(1, 10000, size=(120, 108, 6)).astype(np.uint16)
+    d10[:, :112] = 0
+    d20[:, 90:] = 0
+
+    image = dsen2_20(d10, d20, "MSIL1C")
+    assert image.shape == (240, 216, 6)
+    assert fake_model.patches == 3
+    assert not image[:, :104].any()
+    assert image[:, 112:].all()
+    # Valid predictions of 0 are kept apart from the nodata value.
+    assert (image[:, 184:] == 1).all()
+
+    d10[:] = 0
+    image = dsen2_20(d10, d20, "MSIL1C")
+    assert image.shape == (240, 216, 6) and not image.any()
+    assert fake_model.patches == 3
+
+
+def test_batch_size_kept_after_allocation_failure(fake_model):
+    d10 = np.random.randint(1, 10000, size=(240, 216, 4)).astype(np.uint16)
+    d20 = np.random.randint(1, 10000, size=(120, 108, 6)).astype(np.uint16)
+    fake_model.max_batch_size = 3
+
+    expected = dsen2_20(d10, d20, "MSIL1C")
+    # 6 patches, from batches of BATCH_SIZE halved down to 2.
+    assert fake_model.patches == 6
+    assert fake_model.failures == 6
+    key = supres.MODEL_REGISTRY.key("20m", "MSIL1C")
+    assert supres.MODEL_REGISTRY.batch_size(key, 128, supres.BATCH_SIZE) == 2
+
+    # The next image starts with the reduced batch size.
+    np.testing.assert_array_equal(dsen2_20(d10, d20, "MSIL1C"), expected)
+    assert fake_model.failures == 6
+    assert supres.MODEL_REGISTRY.batch_size(key, 192, supres.BATCH_SIZE) == 128
+
+
+def test_adaptive_predictor():
+    class SmallMemoryModel:
+        name = "small_memory"
+
+        def __init__(self):
+            self.batch_sizes = []
+
+        def predict(self, inputs, batch_size=32):
+            if batch_size > 3:
+                raise MemoryError
+            self.batch_sizes.append(batch_size)
+            return inputs[0] * 2
+
+    model = SmallMemoryModel()
+    predictor = supres.AdaptivePredictor(model, batch_size=16)
+    inputs = [np.arange(10, dtype=np.float32)]
+    predictions = np.concatenate(list(predictor.predict(inputs)))
+    np.testing.assert_array_equal(predictions, inputs[0] * 2)
+    assert predictor.batch_size == 2
+    assert predictor.retries == 3
+    assert model.batch_sizes == [2] * 5
+
+    assert supres.get_batch_size(128, 10, 10 * 1024 ** 4) == supres.MAX_BATCH_SIZE
+    assert supres.get_batch_size(128, 10, 1) == 1
+    budget = supres.estimate_batch_memory(128, 10, 100)
+    assert supres.get_batch_size(128, 10, budget) == 100
+
+
+STARTUP_CHECK = """
+import sys, time
+start = time.perf_counter()
+import inference
+from s2_tiles_supres import Superresolution
+Superresolution({"runtime": "onnx", "auto_tune": True}).assert_input_params()
+print(time.perf_counter() - start, "tensorflow" in sys.modules)
+"""
+
+
+def test_startup_without_tensorflow():
+    """
+    Importing the block and validating its parameters must not load TensorFlow,
+    which is only imported with the first model. Run with -s to see the startup
+    time, `make startup-benchmark` breaks it down by module.
+    """
+    src = os.path.join(os.path.dirname(__file__), "..", "src")
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_CHECK],
+        cwd=src,
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    seconds, tensorflow_loaded = result.stdout.split()[-2:]
+    print(f"Startup without TensorFlow: {float(seconds):.2f}s")
+    assert tensorflow_loaded == "False"
+    assert tf.errors.ResourceExhaustedError in supres.allocation_errors()
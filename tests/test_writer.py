@@ -0,0 +1,102 @@
+"""
+This module include test cases for the writer script.
+"""
+from pathlib import Path
+import tempfile
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from context import writer
+
+
+@pytest.fixture()
+def profile():
+    return {
+        "driver": "JP2OpenJPEG",
+        "dtype": "uint16",
+        "width": 600,
+        "height": 400,
+        "count": 3,
+        "crs": "EPSG:32640",
+        "transform": from_origin(1470996, 6914001, 10.0, 10.0),
+    }
+
+
+def test_get_output_profile(profile):
+    out_profile = writer.get_output_profile(profile, "zstd", 256)
+    assert out_profile["driver"] == "GTiff"
+    assert out_profile["tiled"]
+    assert out_profile["blockxsize"] == out_profile["blockysize"] == 256
+    assert out_profile["compress"] == "ZSTD"
+    assert out_profile["predictor"] == 2
+    assert profile["driver"] == "JP2OpenJPEG"
+
+    assert "compress" not in writer.get_output_profile(profile, "NONE")
+
+    with pytest.raises(ValueError):
+        writer.get_output_profile(profile, "JPEG")
+    with pytest.raises(ValueError):
+        writer.get_output_profile(profile, "DEFLATE", 100)
+
+
+def test_result_writer(profile):
+    image_name = str(Path(tempfile.mkdtemp()) / "out.tif")
+    data = np.arange(400 * 600 * 3, dtype=np.uint16).reshape((400, 600, 3))
+    desc = ["SR B5", "SR B6", "SR B7"]
+
+    with writer.ResultWriter(image_name, profile, desc, tile_size=256) as res:
+        res.write(data[:200], Window(0, 0, 600, 200))
+        res.write(data[200:], Window(0, 200, 600, 200))
+
+    with rasterio.open(image_name) as d_s:
+        assert d_s.profile["tiled"]
+        assert d_s.profile["compress"] == "deflate"
+        assert d_s.block_shapes[0] == (256, 256)
+        assert d_s.descriptions == tuple(desc)
+        np.testing.assert_array_equal(np.moveaxis(d_s.read(), 0, 2), data)
+
+    with writer.ResultWriter(image_name, profile, desc, tile_size=256) as res:
+        res.write_image(data)
+    with rasterio.open(image_name) as d_s:
+        np.testing.assert_array_equal(np.moveaxis(d_s.read(), 0, 2), data)
+    with pytest.raises(ValueError):
+        res.write(data)
+
+
+def test_get_overview_factors():
+    assert writer.get_overview_factors(10980, 10980) == [2, 4, 8, 16, 32]
+    assert writer.get_overview_factors(1100, 300) == [2, 4]
+    assert writer.get_overview_factors(512, 512) == []
+
+
+def test_result_writer_cog(profile):
+    image_dir = Path(tempfile.mkdtemp())
+    image_name = str(image_dir / "out.tif")
+    data = np.arange(400 * 600 * 3, dtype=np.uint16).reshape((400, 600, 3))
+
+    with writer.ResultWriter(
+        image_name, profile, ["SR B5", "SR B6", "SR B7"], "ZSTD", 256, "COG"
+    ) as res:
+        res.write(data[:, :300], Window(0, 0, 300, 400))
+        res.write(data[:, 300:], Window(300, 0, 300, 400))
+
+    assert [p.name for p in image_dir.iterdir()] == ["out.tif"]
+    with rasterio.open(image_name) as d_s:
+        assert d_s.tags(ns="IMAGE_STRUCTURE")["LAYOUT"] == "COG"
+        assert d_s.overviews(1) == [2, 4]
+        assert d_s.block_shapes[0] == (256, 256)
+        assert d_s.profile["compress"] == "zstd"
+        assert d_s.descriptions == ("SR B5", "SR B6", "SR B7")
+        np.testing.assert_array_equal(np.moveaxis(d_s.read(), 0, 2), data)
+
+    with pytest.raises(RuntimeError):
+        with writer.ResultWriter(image_name + "2", profile, [], output_format="COG"):
+            raise RuntimeError()
+    assert [p.name for p in image_dir.iterdir()] == ["out.tif"]
+
+    with pytest.raises(ValueError):
+        writer.ResultWriter(image_name, profile, [], output_format="PNG")